@@ -11,33 +11,20 @@ from flask_jwt_extended import JWTManager, create_access_token, jwt_required, ge
 from functools import wraps
 import re
 
-import os
-from pymongo import MongoClient
+from pymongo import ReturnDocument
+
+import mongo
 
 from sub_config import SUBSCRIPTION_TIERS
+from user_search import SEARCH_FIELDS, SORT_KEYS, decode_cursor, encode_cursor, search_query, search_terms
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Create admin blueprint
 admin_bp = Blueprint('admin', __name__, url_prefix='/api/admin')
 
-try:
-    # Replace <db_password> with the actual database password
-    mongo_uri = admin_bp.config['MONGO_URI'].replace('<db_password>', os.environ.get('DB_PASSWORD', ''))
-    client = MongoClient(mongo_uri)
-    db = client.image_visualization  # Database name
-    
-    # Collections
-    users_collection = db.users
-    images_collection = db.images
-    
-    # Create indexes for better query performance
-    users_collection.create_index('email', unique=True)
-    images_collection.create_index('owner')
-    
-    print("Connected to MongoDB successfully!")
-except Exception as e:
-    print(f"Failed to connect to MongoDB: {e}")
-    raise
+# Collections on the app's shared MongoDB connection
+users_collection = mongo.database.users
+images_collection = mongo.database.images
 
 
 # Include the admin_required decorator
@@ -74,6 +61,18 @@ def admin_required(fn):
         return fn(*args, **kwargs)
     return wrapper
 
+# Drop a user from the app's account cache after an admin change
+def invalidate_cached_user(email):
+    user_cache = current_app.extensions.get('user_cache')
+    if user_cache:
+        user_cache.invalidate(email)
+
+# Count a new user in the dashboard's monthly registrations
+def record_registration(created_at):
+    dashboard_stats = current_app.extensions.get('dashboard_stats')
+    if dashboard_stats:
+        dashboard_stats.record_registration(created_at)
+
 # Add these routes to your app.py
 
 # Get all users (admin only)
@@ -99,30 +98,52 @@ def get_all_users():
         query['role'] = role_filter
         
     if search:
-        # Search in email, first_name, last_name, or company_name
-        query['$or'] = [
-            {'email': {'$regex': search, '$options': 'i'}},
-            {'first_name': {'$regex': search, '$options': 'i'}},
-            {'last_name': {'$regex': search, '$options': 'i'}},
-            {'company_name': {'$regex': search, '$options': 'i'}}
-        ]
-    
-    # Pagination
-    page = int(request.args.get('page', 1))
-    per_page = int(request.args.get('per_page', 10))
-    skip = (page - 1) * per_page
+        # Words starting email, first_name, last_name or company_name words,
+        # matched against the indexed lowercase search_terms
+        query.update(search_query(search))
     
     # Sorting
     sort_by = request.args.get('sort_by', 'created_at')
-    sort_order = int(request.args.get('sort_order', -1))  # -1 for descending, 1 for ascending
+    sort_order = 1 if request.args.get('sort_order') == '1' else -1  # -1 for descending, 1 for ascending
+    if sort_by not in SORT_KEYS:
+        return jsonify({'error': f"sort_by must be one of {', '.join(SORT_KEYS)}"}), 400
+    
+    # Pagination: pages follow on from the cursor of the previous page
+    try:
+        per_page = min(max(int(request.args.get('per_page', 10)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'per_page must be a number'}), 400
+    
+    if request.args.get('cursor'):
+        try:
+            query = {'$and': [query, decode_cursor(request.args['cursor'], sort_by, sort_order)]}
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    # Counting every match is a scan of its own, so only on request;
+    # otherwise an unfiltered list reports the collection's estimated size
+    filtered = bool(status_filter or role_filter or search)
+    if request.args.get('count') == 'exact':
+        total_users = users_collection.count_documents(query)
+    elif not filtered:
+        total_users = users_collection.estimated_document_count()
+    else:
+        total_users = None
     
-    # Execute query
-    total_users = users_collection.count_documents(query)
-    users_cursor = users_collection.find(query).sort(sort_by, sort_order).skip(skip).limit(per_page)
+    # Execute query; one extra user tells whether there is a next page
+    users_cursor = users_collection.find(query, {'password_hash': 0, 'search_terms': 0}).sort(
+        [(sort_by, sort_order), ('_id', sort_order)]
+    ).limit(per_page + 1)
     
     # Format results
     users = []
+    next_cursor = None
     for user in users_cursor:
+        if len(users) == per_page:
+            next_cursor = encode_cursor(last_user, sort_by)
+            break
+        last_user = user
+        
         # Remove sensitive data
         user.pop('password_hash', None)
         
@@ -144,9 +165,9 @@ def get_all_users():
     return jsonify({
         'users': users,
         'total': total_users,
-        'page': page,
+        'total_is_estimate': total_users is not None and request.args.get('count') != 'exact',
         'per_page': per_page,
-        'total_pages': (total_users + per_page - 1) // per_page
+        'next_cursor': next_cursor
     }), 200
 
 # Get user by ID (admin only)
@@ -206,14 +227,21 @@ def update_user(user_id):
         return jsonify({'error': 'No valid fields to update'}), 400
     
     # Update user
-    result = users_collection.update_one(
+    user = users_collection.find_one_and_update(
         {'_id': object_id},
-        {'$set': update_data}
+        {'$set': update_data},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if not user:
         return jsonify({'error': 'User not found'}), 404
     
+    # Keep the user findable under their new name
+    if any(field in update_data for field in SEARCH_FIELDS):
+        users_collection.update_one({'_id': object_id}, {'$set': {'search_terms': search_terms(user)}})
+    
+    invalidate_cached_user(user['email'])
+    
     return jsonify({'message': 'User updated successfully'}), 200
 
 # Activate/deactivate user (admin only)
@@ -234,17 +262,17 @@ def set_user_activation(user_id):
         'pending_activation': False
     }
     
-    # Update user
-    result = users_collection.update_one(
+    # Update user, getting back their email for the response
+    user = users_collection.find_one_and_update(
         {'_id': object_id},
-        {'$set': update_data}
+        {'$set': update_data},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
+    if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    # Fetch the updated user to get their email for the response
-    user = users_collection.find_one({'_id': object_id})
+    invalidate_cached_user(user['email'])
     
     action = 'activated' if activate else 'deactivated'
     return jsonify({
@@ -255,69 +283,9 @@ def set_user_activation(user_id):
 @admin_bp.route('/api/admin/stats', methods=['GET'])
 @admin_required
 def get_admin_stats():
-    # Count total users
-    total_users = users_collection.count_documents({})
-    active_users = users_collection.count_documents({'is_active': True})
-    pending_users = users_collection.count_documents({'pending_activation': True})
-    
-    # Count users by subscription tier
-    subscription_stats = {}
-    for tier in SUBSCRIPTION_TIERS.keys():
-        count = users_collection.count_documents({'subscription.tier': tier})
-        subscription_stats[tier] = count
-    
-    # Count total images
-    total_images = images_collection.count_documents({})
-    
-    # Get user registrations by month (last 6 months)
-    now = datetime.now()
-    months = []
-    registrations_by_month = []
-    
-    for i in range(5, -1, -1):
-        # Get start and end of month
-        month_start = datetime(now.year, now.month, 1) - timedelta(days=30*i)
-        if i > 0:
-            month_end = datetime(now.year, now.month, 1) - timedelta(days=30*(i-1))
-        else:
-            month_end = datetime(now.year, now.month+1, 1) if now.month < 12 else datetime(now.year+1, 1, 1)
-        
-        # Format month name
-        month_name = month_start.strftime('%b %Y')
-        months.append(month_name)
-        
-        # Count registrations in this month
-        count = users_collection.count_documents({
-            'created_at': {'$gte': month_start, '$lt': month_end}
-        })
-        registrations_by_month.append(count)
-    
-    # Get most used scenes
-    pipeline = [
-        {"$unwind": "$generated_images"},
-        {"$group": {"_id": "$generated_images.scene", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
-    ]
-    scene_stats = list(images_collection.aggregate(pipeline))
-    scene_stats = [{"scene": item["_id"], "count": item["count"]} for item in scene_stats]
-    
-    return jsonify({
-        'users': {
-            'total': total_users,
-            'active': active_users,
-            'pending': pending_users
-        },
-        'subscriptions': subscription_stats,
-        'images': {
-            'total': total_images
-        },
-        'registrations': {
-            'months': months,
-            'counts': registrations_by_month
-        },
-        'scenes': scene_stats
-    }), 200
+    # One aggregation over users plus counters kept up to date on writes,
+    # reused for ADMIN_STATS_TTL seconds; the response says how old it is
+    return jsonify(current_app.extensions['dashboard_stats'].get()), 200
 
 # Create admin user (for initial setup)
 @admin_bp.route('/api/admin/setup', methods=['POST'])
@@ -374,8 +342,11 @@ def admin_setup():
         }
     }
     
+    new_admin['search_terms'] = search_terms(new_admin)
+    
     # Insert admin user
     result = users_collection.insert_one(new_admin)
+    record_registration(new_admin['created_at'])
     
     # Create access token
     access_token = create_access_token(identity=email)
@@ -472,8 +443,11 @@ def register():
         }
     }
     
+    new_user['search_terms'] = search_terms(new_user)
+    
     # Insert user into database
     result = users_collection.insert_one(new_user)
+    record_registration(new_user['created_at'])
     
     # Only create token if activation is not required
     if not requires_activation:
@@ -4,25 +4,58 @@ load_dotenv()
 
 import os
 import base64
+import mimetypes
+from functools import lru_cache
 import json
 import uuid
+import itertools
+import time
 from datetime import datetime, timedelta
 from io import BytesIO
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify, send_file, redirect, stream_with_context
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
 from PIL import Image, ImageOps
 import PIL.Image
 import requests
 from google import genai
 from google.genai import types
-from pymongo import MongoClient
+from pymongo import ReturnDocument
 from bson.objectid import ObjectId
 
 from admin.routes import admin_bp
+from image_utils import (
+    DEFAULT_WHITE_THRESHOLD,
+    DEFAULT_CUTOUT_MEMORY_BUDGET,
+    ENCODED_IMAGE_EXTENSIONS,
+    RENDITION_FORMATS,
+    THUMBNAIL_SIZES,
+    THUMBNAIL_FITS,
+    sniff_image_format,
+    save_encoded_image,
+    add_image_extension,
+    save_compact_image,
+    probe_image,
+    make_thumbnail
+)
+from processing_pool import ProcessingPool
+from jobs import JobQueue
+from gemini_client import get_client_pool, image_part, payload_cache_stats, DEFAULT_POOL_SIZE
+from blob_store import BlobStore
+from generated_store import GeneratedImageStore
+from upload_stream import receive_upload, DEFAULT_MAX_PIXELS
+from generation_cache import GenerationCache, cache_key, file_digest, DEFAULT_MAX_BYTES, DEFAULT_MAX_AGE
+from rendition_cache import RenditionCache, DEFAULT_MAX_BYTES as DEFAULT_RENDITION_CACHE_BYTES
+from storage import create_storage, storage_key, DEFAULT_KEY_CACHE_TTL
+from user_cache import UserCache, DEFAULT_TTL as DEFAULT_USER_CACHE_TTL
+from quota import Quota, QuotaExceeded
+from user_search import backfill_search_terms, create_indexes as create_user_search_indexes, search_terms
+from dashboard_stats import DashboardStats, DEFAULT_TTL as DEFAULT_ADMIN_STATS_TTL
+import mongo
+from metrics import add_scrape_gauge, gemini_call, observe_request, render as render_metrics, stage
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -36,44 +69,207 @@ CORS(app)
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev-secret-key')
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['PROCESSED_FOLDER'] = 'processed'
+# Largest accepted request body; leaves room above the 10MB the upload page allows
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 12 * 1024 * 1024))
+app.config['UPLOAD_MAX_PIXELS'] = int(os.environ.get('UPLOAD_MAX_PIXELS', DEFAULT_MAX_PIXELS))
+# Local scratch space for files on their way into storage
+app.config['STAGING_FOLDER'] = os.environ.get('STAGING_FOLDER', 'staging')
+# Where uploads and outputs are kept: 'local' (sharded under STORAGE_ROOT) or 's3'
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+app.config['STORAGE_ROOT'] = os.environ.get('STORAGE_ROOT', '.')
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+app.config['S3_REGION'] = os.environ.get('S3_REGION')
+app.config['S3_ACCESS_KEY'] = os.environ.get('S3_ACCESS_KEY')
+app.config['S3_SECRET_KEY'] = os.environ.get('S3_SECRET_KEY')
+# Seconds presigned URLs stay valid; redirects to them are cached for slightly less
+app.config['S3_URL_EXPIRY'] = int(os.environ.get('S3_URL_EXPIRY', 3600))
+# Seconds a worker reuses an object store's answer to whether a key exists
+app.config['S3_KEY_CACHE_TTL'] = float(os.environ.get('S3_KEY_CACHE_TTL', DEFAULT_KEY_CACHE_TTL))
 app.config['GEMINI_API_KEY'] = os.environ.get('GEMINI_API_KEY')
 app.config['STRIPE_API_KEY'] = os.environ.get('STRIPE_API_KEY')
 app.config['MONGO_URI'] = os.environ.get('MONGO_URI', 'mongodb+srv://uttampipliya4:<db_password>@imagedb.yba6h.mongodb.net/?retryWrites=true&w=majority&appName=ImageDB')
+# Connection pool of each worker process; connections are opened as requests need them
+app.config['MONGO_MAX_POOL_SIZE'] = int(os.environ.get('MONGO_MAX_POOL_SIZE', mongo.DEFAULT_MAX_POOL_SIZE))
+app.config['MONGO_MIN_POOL_SIZE'] = int(os.environ.get('MONGO_MIN_POOL_SIZE', mongo.DEFAULT_MIN_POOL_SIZE))
+app.config['MONGO_MAX_IDLE_TIME_MS'] = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', mongo.DEFAULT_MAX_IDLE_TIME_MS))
+app.config['MONGO_CONNECT_TIMEOUT_MS'] = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', mongo.DEFAULT_CONNECT_TIMEOUT_MS))
+app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', mongo.DEFAULT_SERVER_SELECTION_TIMEOUT_MS))
+app.config['MONGO_SOCKET_TIMEOUT_MS'] = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', mongo.DEFAULT_SOCKET_TIMEOUT_MS))
+# Wire compression, in order of preference, e.g. 'zstd,snappy,zlib'; empty disables it
+app.config['MONGO_COMPRESSORS'] = os.environ.get('MONGO_COMPRESSORS', mongo.DEFAULT_COMPRESSORS)
+app.config['WHITE_THRESHOLD'] = int(os.environ.get('WHITE_THRESHOLD', DEFAULT_WHITE_THRESHOLD))
+app.config['CUTOUT_MEMORY_BUDGET'] = int(os.environ.get('CUTOUT_MEMORY_BUDGET', DEFAULT_CUTOUT_MEMORY_BUDGET))
+app.config['PROCESSING_WORKERS'] = int(os.environ.get('PROCESSING_WORKERS', os.cpu_count() or 1))
+app.config['PROCESSING_TIMEOUT'] = float(os.environ.get('PROCESSING_TIMEOUT', 60))
+app.config['GENERATION_WORKERS'] = int(os.environ.get('GENERATION_WORKERS', 4))
+app.config['JOB_LEASE_SECONDS'] = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+app.config['GEMINI_CLIENT_POOL_SIZE'] = int(os.environ.get('GEMINI_CLIENT_POOL_SIZE', DEFAULT_POOL_SIZE))
+app.config['GENERATION_CACHE_FOLDER'] = os.environ.get('GENERATION_CACHE_FOLDER', 'generation_cache')
+app.config['GENERATION_CACHE_MAX_BYTES'] = int(os.environ.get('GENERATION_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+app.config['GENERATION_CACHE_MAX_AGE'] = int(os.environ.get('GENERATION_CACHE_MAX_AGE', DEFAULT_MAX_AGE))
+# Format generated images are converted to in the background (empty keeps the model's)
+app.config['GENERATED_IMAGE_FORMAT'] = os.environ.get('GENERATED_IMAGE_FORMAT', 'WEBP').upper()
+app.config['GENERATED_IMAGE_QUALITY'] = int(os.environ.get('GENERATED_IMAGE_QUALITY', 90))
+# Encoding level of the WebP and progressive JPEG renditions served by /processed
+app.config['RENDITION_QUALITY'] = int(os.environ.get('RENDITION_QUALITY', 85))
+# Browser and CDN lifetime of served image files, which never change once written
+app.config['IMAGE_CACHE_MAX_AGE'] = int(os.environ.get('IMAGE_CACHE_MAX_AGE', 365 * 24 * 3600))
+app.config['RENDITION_CACHE_FOLDER'] = os.environ.get('RENDITION_CACHE_FOLDER', 'renditions')
+app.config['RENDITION_CACHE_MAX_BYTES'] = int(os.environ.get('RENDITION_CACHE_MAX_BYTES', DEFAULT_RENDITION_CACHE_BYTES))
+# Size of the thumbnails listed by /api/images for gallery cards
+app.config['GALLERY_THUMBNAIL'] = {'w': 480, 'h': 320, 'fit': 'cover'}
+# Largest page of images /api/images returns when asked for pages
+app.config['GALLERY_MAX_PAGE_SIZE'] = int(os.environ.get('GALLERY_MAX_PAGE_SIZE', 200))
+# Seconds a worker serves a user's account from memory; other workers see
+# subscription and admin changes at most this late
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', DEFAULT_USER_CACHE_TTL))
+# Seconds the admin dashboard figures are reused before being computed again
+app.config['ADMIN_STATS_TTL'] = float(os.environ.get('ADMIN_STATS_TTL', DEFAULT_ADMIN_STATS_TTL))
 
 
 # Set Gemini API key
 genai.api_key = app.config['GEMINI_API_KEY']
 
-# Connect to MongoDB
-try:
+# Long-lived Gemini clients shared by every request in this process
+gemini_pool = get_client_pool(
+    app.config['GEMINI_API_KEY'],
+    size=app.config['GEMINI_CLIENT_POOL_SIZE']
+)
+
+# MongoDB, shared with the admin blueprint; nothing connects until the
+# first query, and indexes are created by `flask migrate`, not at startup
+mongo.connection.configure(
     # Replace <db_password> with the actual database password
-    mongo_uri = app.config['MONGO_URI'].replace('<db_password>', os.environ.get('DB_PASSWORD', ''))
-    client = MongoClient(mongo_uri)
-    db = client.image_visualization  # Database name
-    
-    # Collections
-    users_collection = db.users
-    images_collection = db.images
-    
-    # Create indexes for better query performance
-    users_collection.create_index('email', unique=True)
-    images_collection.create_index('owner')
-    
-    print("Connected to MongoDB successfully!")
-except Exception as e:
-    print(f"Failed to connect to MongoDB: {e}")
-    raise
+    app.config['MONGO_URI'].replace('<db_password>', os.environ.get('DB_PASSWORD', '')),
+    maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'],
+    minPoolSize=app.config['MONGO_MIN_POOL_SIZE'],
+    maxIdleTimeMS=app.config['MONGO_MAX_IDLE_TIME_MS'],
+    connectTimeoutMS=app.config['MONGO_CONNECT_TIMEOUT_MS'],
+    serverSelectionTimeoutMS=app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+    socketTimeoutMS=app.config['MONGO_SOCKET_TIMEOUT_MS'] or None,
+    compressors=app.config['MONGO_COMPRESSORS'] or None
+)
+db = mongo.database
+
+# Collections
+users_collection = db.users
+images_collection = db.images
+jobs_collection = db.jobs
+blobs_collection = db.blobs
 
 # Ensure directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
+os.makedirs(app.config['STAGING_FOLDER'], exist_ok=True)
+
+# Blob storage for originals, cutouts, generated images and their renditions
+storage = create_storage(app.config)
 
 # Initialize JWT
 jwt = JWTManager(app)
 
+# Account lookups behind the JWT identity, shared with the admin blueprint
+user_cache = UserCache(users_collection, ttl=app.config['USER_CACHE_TTL'])
+app.extensions['user_cache'] = user_cache
+
+# Reference-counted, content-addressed originals and cutouts
+blob_store = BlobStore(blobs_collection)
+
+# Generated images, one document each rather than an array in the image record
+generated_store = GeneratedImageStore(db.generated_images, images_collection)
+
+# Generated images keyed by input, prompt and model, shared by all workers
+generation_cache = GenerationCache(
+    app.config['GENERATION_CACHE_FOLDER'],
+    max_bytes=app.config['GENERATION_CACHE_MAX_BYTES'],
+    max_age=app.config['GENERATION_CACHE_MAX_AGE']
+)
+
+# Resized thumbnails for gallery views, evicted least-recently-used
+thumbnail_cache = RenditionCache(
+    app.config['RENDITION_CACHE_FOLDER'],
+    max_bytes=app.config['RENDITION_CACHE_MAX_BYTES']
+)
+
+# Worker processes for CPU-bound pixel work, started on first upload
+processing_pool = ProcessingPool(
+    max_workers=app.config['PROCESSING_WORKERS'],
+    timeout=app.config['PROCESSING_TIMEOUT']
+)
+
+# Background generation jobs, persisted in MongoDB so they survive restarts
+job_queue = JobQueue(
+    jobs_collection,
+    # Late-bound: the handler is defined further down this module
+    handlers={
+        'generate': lambda job: run_generation_job(job),
+        'convert': lambda job: run_conversion_job(job)
+    },
+    abandon_handlers={
+        'generate': lambda job: abandon_generation_job(job)
+    },
+    max_workers=app.config['GENERATION_WORKERS'],
+    lease_seconds=app.config['JOB_LEASE_SECONDS']
+)
+
+@app.before_request
+def start_job_workers():
+    # Picks up jobs left behind by a worker that restarted
+    job_queue.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # Labelled by URL rule rather than path so ids do not create new series
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe_request(request.method, route, response.status_code, time.perf_counter() - g.request_started)
+    return response
+
+# Jobs waiting in MongoDB; the same whichever worker answers the scrape
+add_scrape_gauge('job_queue_jobs', 'Background jobs by status', 'status', job_queue.depths)
+
 # Subscription tiers
 from sub_config import SUBSCRIPTION_TIERS
 
+# Monthly image allowance, reserved atomically before each generation
+quota = Quota(users_collection, SUBSCRIPTION_TIERS, user_cache=user_cache)
+
+# Admin dashboard figures; scene and registration counters are kept up to
+# date by the writes below, and built from existing data by `flask migrate`
+dashboard_stats = DashboardStats(db, SUBSCRIPTION_TIERS, ttl=app.config['ADMIN_STATS_TTL'])
+app.extensions['dashboard_stats'] = dashboard_stats
+
+def create_indexes():
+    """Create the indexes every query relies on; existing ones are left as they are"""
+    users_collection.create_index('email', unique=True)
+    # Admin user search and keyset-paged user lists
+    create_user_search_indexes(users_collection)
+    images_collection.create_index('owner')
+    # Gallery listing: a user's images newest first, paged by keyset
+    images_collection.create_index([('owner', 1), ('created_at', -1), ('_id', -1)])
+    jobs_collection.create_index([('status', 1), ('created_at', 1)])
+    jobs_collection.create_index('owner')
+    generated_store.create_indexes()
+    dashboard_stats.create_indexes()
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create indexes and bring existing records up to date; safe to run again."""
+    create_indexes()
+    # Users registered before admin search was indexed
+    backfill_search_terms(users_collection)
+    # Counters start from the existing data the first time
+    dashboard_stats.ensure_built()
+    # Generated images still embedded in their image records
+    generated_store.migrate()
+    print("Database is up to date")
+
+# Model used to place products into scenes
+GEMINI_IMAGE_MODEL = "gemini-2.0-flash-exp-image-generation"
 
 # Scene templates
 SCENE_TEMPLATES = {
@@ -97,19 +293,299 @@ def to_json_serializable(obj):
 @app.route('/uploads/<filename>')
 def serve_upload(filename):
     """Serve original uploaded images"""
-    response = send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-    # Add CORS headers
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    return response
+    return serve_image('UPLOAD_FOLDER', filename, negotiate=False)
 
 @app.route('/processed/<filename>')
 def serve_processed(filename):
     """Serve processed and generated images"""
-    response = send_file(os.path.join(app.config['PROCESSED_FOLDER'], filename))
+    return serve_image('PROCESSED_FOLDER', filename, negotiate=True)
+
+def serve_image(folder, filename, negotiate):
+    """Serve a stored image, a thumbnail of it or a rendition for the Accept header"""
+    key = resolve_key(folder, filename)
+    if key is None:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    try:
+        if thumbnail_requested():
+            response = send_image(*get_thumbnail(key))
+        elif negotiate:
+            response = send_stored_image(*negotiate_image(key))
+        else:
+            response = send_stored_image(key)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Thumbnails and renditions depend on the Accept header
+    response.headers.add('Vary', 'Accept')
     # Add CORS headers
     response.headers.add('Access-Control-Allow-Origin', '*')
     return response
 
+def resolve_key(folder, filename):
+    """
+    Storage key of a file served by name. Files stored before keys were
+    sharded sit directly in the folder.
+    """
+    candidates = [storage_key(app.config[folder], filename), f"{app.config[folder]}/{filename}"]
+    
+    # Generated images are re-encoded after their URL is handed out and the
+    # original is then deleted, so URLs given out earlier find the new file
+    name, extension = os.path.splitext(filename)
+    converted_extension = ENCODED_IMAGE_EXTENSIONS.get(app.config['GENERATED_IMAGE_FORMAT'])
+    if name.startswith('generated_') and converted_extension and extension != converted_extension:
+        candidates.insert(0, storage_key(app.config[folder], name + converted_extension))
+    
+    for key in candidates:
+        if storage.exists(key):
+            return key
+    return None
+
+def staging_path(extension=''):
+    """New local scratch path for a file on its way into storage"""
+    return os.path.join(app.config['STAGING_FOLDER'], f"{uuid.uuid4()}{extension}")
+
+# Bytes fetched to probe a stored image; holds the header of the formats served
+PROBE_HEAD_BYTES = 64 * 1024
+
+@lru_cache(maxsize=4096)
+def probe_stored_image(key):
+    """
+    probe_image for a stored file; keys never change content, so results
+    are kept. Only the start of the file is fetched unless its header runs
+    past it.
+    """
+    head = storage.read_head(key, PROBE_HEAD_BYTES)
+    try:
+        return probe_image(BytesIO(head))
+    except OSError:
+        if len(head) < PROBE_HEAD_BYTES:
+            raise
+    
+    with storage.local_copy(key) as path:
+        return probe_image(path)
+
+def get_stored_rendition(key, mime_type):
+    """
+    Return the key of a stored image's rendition in another format, encoding
+    it on first use. Renditions are stored next to the original.
+    """
+    image_format, extension = RENDITION_FORMATS[mime_type]
+    rendition_key = key + extension
+    if storage.exists(rendition_key):
+        return rendition_key
+    
+    # Concurrent first requests may both encode; either result is complete
+    temp_path = staging_path(extension)
+    try:
+        with storage.local_copy(key) as path, Image.open(path) as img, stage('rendition'):
+            save_compact_image(img, temp_path, image_format, app.config['RENDITION_QUALITY'])
+        storage.put_file(rendition_key, temp_path, mime_type)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    return rendition_key
+
+def image_keys(image_data):
+    """Storage keys of an image record's original and cutout"""
+    # Records from before storage keys hold flat paths, which resolve as keys
+    if 'original_key' in image_data:
+        return image_data['original_key'], image_data['processed_key']
+    return image_data['original_path'], image_data['processed_path']
+
+def delete_stored_image(key):
+    """Delete a stored image together with its renditions and thumbnails"""
+    for extension in [''] + [extension for _, extension in RENDITION_FORMATS.values()]:
+        storage.delete(key + extension)
+    delete_thumbnails(key)
+
+def negotiate_image(key):
+    """
+    Pick the stored image or a rendition that suits the Accept header.
+    Returns the key to send and its mime type.
+    """
+    # Only explicitly listed types count; */* clients get the stored file
+    accepted = {mime_type for mime_type, quality in request.accept_mimetypes if quality > 0}
+    # Older cutouts are PNGs named after the upload, so trust the header
+    original_type, transparent = probe_stored_image(key)
+    
+    if 'image/webp' in accepted:
+        if original_type in ('image/png', 'image/jpeg', 'image/gif'):
+            return get_stored_rendition(key, 'image/webp'), 'image/webp'
+        return key, original_type
+    
+    # Clients that list image types but not WebP get a progressive JPEG;
+    # JPEG has no alpha channel, so cutouts stay as they are
+    if original_type in ('image/png', 'image/webp') and not transparent:
+        if accepted & {'image/jpeg', 'image/png', 'image/*'}:
+            return get_stored_rendition(key, 'image/jpeg'), 'image/jpeg'
+    
+    return key, original_type
+
+
+def send_image(path, mime_type=None):
+    """
+    Send an image file with long-lived caching headers. Uploads, generated
+    images and renditions are never rewritten under the same name, so they
+    are immutable. send_file adds a strong ETag and Last-Modified, answers
+    If-None-Match and If-Modified-Since with 304 and serves Range requests.
+    """
+    response = send_file(
+        path,
+        mimetype=mime_type,
+        conditional=True,
+        max_age=app.config['IMAGE_CACHE_MAX_AGE']
+    )
+    response.headers['Cache-Control'] = f"public, max-age={app.config['IMAGE_CACHE_MAX_AGE']}, immutable"
+    return response
+
+def send_stored_image(key, mime_type=None):
+    """
+    Send a stored image, or redirect to it when the storage serves files
+    itself. Clients keep the redirect for as long as the storage hands out
+    the same URL, so repeat views skip the app.
+    """
+    signed = storage.url(key)
+    if signed:
+        url, max_age = signed
+        response = redirect(url)
+        # The URL is signed and expires, so shared caches must not keep it
+        response.headers['Cache-Control'] = f"private, max-age={max_age}"
+        return response
+    return send_image(storage.local_path(key), mime_type)
+
+# Thumbnail formats with their mime type and file extension
+THUMBNAIL_ENCODINGS = {
+    'WEBP': ('image/webp', '.webp'),
+    'PNG': ('image/png', '.png'),
+    'JPEG': ('image/jpeg', '.jpg')
+}
+
+def thumbnail_requested():
+    return any(arg in request.args for arg in ('w', 'h', 'fit'))
+
+def get_thumbnail(key):
+    """
+    Serve a resized rendition of a stored image from the local thumbnail
+    cache, creating it once.
+    Sizes and fits are limited to a whitelist so the cache stays bounded.
+    Returns the path to send and its mime type.
+    """
+    width = request.args.get('w', type=int)
+    height = request.args.get('h', type=int)
+    fit = request.args.get('fit', 'contain')
+    
+    if not width and not height:
+        raise ValueError('Thumbnail width or height is required')
+    for value in (width, height):
+        if value and value not in THUMBNAIL_SIZES:
+            raise ValueError(f"Thumbnail size must be one of {list(THUMBNAIL_SIZES)}")
+    if fit not in THUMBNAIL_FITS:
+        raise ValueError(f"Thumbnail fit must be one of {list(THUMBNAIL_FITS)}")
+    
+    # WebP where accepted, otherwise JPEG unless transparency must be kept
+    accepted = {mime_type for mime_type, quality in request.accept_mimetypes if quality > 0}
+    if 'image/webp' in accepted:
+        image_format = 'WEBP'
+    elif probe_stored_image(key)[1]:
+        image_format = 'PNG'
+    else:
+        image_format = 'JPEG'
+    mime_type, extension = THUMBNAIL_ENCODINGS[image_format]
+    
+    def produce(thumbnail_path):
+        with storage.local_copy(key) as path, stage('thumbnail'), make_thumbnail(path, width, height, fit) as img:
+            save_compact_image(img, thumbnail_path, image_format, app.config['RENDITION_QUALITY'])
+    
+    rendition = thumbnail_rendition(key, width, height, fit, image_format)
+    return thumbnail_cache.get_or_create(rendition, extension, produce), mime_type
+
+def thumbnail_rendition(key, width, height, fit, image_format):
+    """Thumbnail cache key of a stored image at one size, fit and format"""
+    return f"{key}|{width}|{height}|{fit}|{image_format}"
+
+def delete_thumbnails(key):
+    """
+    Remove a stored image's thumbnails from the thumbnail cache. Cached files
+    are named by hash, so every size, fit and format get_thumbnail accepts
+    is tried.
+    """
+    sizes = (None,) + tuple(THUMBNAIL_SIZES)
+    for width, height in itertools.product(sizes, sizes):
+        if not width and not height:
+            continue
+        for fit in THUMBNAIL_FITS:
+            for image_format, (_, extension) in THUMBNAIL_ENCODINGS.items():
+                thumbnail_cache.discard(thumbnail_rendition(key, width, height, fit, image_format), extension)
+
+def thumbnail_url(url):
+    """Gallery-card-sized variant of a /uploads or /processed URL"""
+    thumbnail = app.config['GALLERY_THUMBNAIL']
+    return f"{url}?w={thumbnail['w']}&h={thumbnail['h']}&fit={thumbnail['fit']}"
+
+# Images listed together with one query for their generated images
+GALLERY_BATCH_SIZE = 100
+
+# Fields of an image document the gallery listing shows; generated images
+# are only embedded in records the migration has not reached yet
+GALLERY_PROJECTION = {
+    'created_at': 1,
+    'generated_images.id': 1,
+    'generated_images.key': 1,
+    'generated_images.path': 1,
+    'generated_images.scene': 1,
+    'generated_images.prompt': 1,
+    'generated_images.created_at': 1
+}
+
+def encode_page_cursor(image_data):
+    """Opaque cursor pointing just past an image in the gallery ordering"""
+    position = json.dumps([image_data['created_at'].isoformat(), str(image_data['_id'])])
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+def decode_page_cursor(cursor):
+    """Query clause selecting the images after a cursor; raises ValueError if malformed"""
+    try:
+        created_at, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        created_at, image_id = datetime.fromisoformat(created_at), ObjectId(image_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    
+    # Newest first, ties broken by id
+    return {'$or': [
+        {'created_at': {'$lt': created_at}},
+        {'created_at': created_at, '_id': {'$lt': image_id}}
+    ]}
+
+def generated_image_info(gen_img):
+    """API form of a generated image entry; storage keys are reported as paths"""
+    created_at = gen_img.get('created_at')
+    return {
+        'id': gen_img['id'],
+        'path': gen_img['key'],
+        'scene': gen_img.get('scene'),
+        'prompt': gen_img.get('prompt'),
+        'created_at': created_at.isoformat() if isinstance(created_at, datetime) else created_at
+    }
+
+def gallery_item(image_data, generated_images):
+    """Gallery listing entry for a projected image document and its generated images"""
+    image_info = {
+        'id': str(image_data['_id']),
+        'created_at': image_data['created_at'].isoformat(),
+        'generated_images': []
+    }
+    
+    # Add URLs to generated images
+    for gen_img in generated_images:
+        gen_img_info = generated_image_info(gen_img)
+        gen_img_info['url'] = f"/processed/{os.path.basename(gen_img_info['path'])}"
+        gen_img_info['thumbnail_url'] = thumbnail_url(gen_img_info['url'])
+        image_info['generated_images'].append(gen_img_info)
+    
+    return image_info
+
 
 # Authentication routes
 @app.route('/api/register', methods=['POST'])
@@ -147,8 +623,11 @@ def register():
         }
     }
     
+    new_user['search_terms'] = search_terms(new_user)
+    
     # Insert user into database
     result = users_collection.insert_one(new_user)
+    dashboard_stats.record_registration(new_user['created_at'])
     
     # Create access token
     access_token = create_access_token(identity=email)
@@ -199,14 +678,17 @@ def subscribe():
         'next_billing_date': datetime.now() + timedelta(days=30)
     }
     
-    # Update user's subscription in MongoDB
-    result = users_collection.update_one(
+    # Update user's subscription in MongoDB, caching the updated account
+    user = users_collection.find_one_and_update(
         {'email': email},
-        {'$set': {'subscription': subscription_update}}
+        {'$set': {'subscription': subscription_update}},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.modified_count == 0:
+    if not user:
+        user_cache.invalidate(email)
         return jsonify({'error': 'Failed to update subscription'}), 500
+    user_cache.put(user)
     
     return jsonify({'message': f'Successfully subscribed to {tier} tier'}), 200
 
@@ -216,7 +698,7 @@ def get_subscription():
     email = get_jwt_identity()
     
     # Find user
-    user = users_collection.find_one({'email': email})
+    user = user_cache.get(email)
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -251,7 +733,7 @@ def upload_image():
     email = get_jwt_identity()
     
     # Find user
-    user = users_collection.find_one({'email': email})
+    user = user_cache.get(email)
     
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -260,36 +742,57 @@ def upload_image():
     if not user.get('subscription'):
         return jsonify({'error': 'Active subscription required'}), 403
     
-    # Check if user has reached their image limit
-    tier = user['subscription']['tier']
-    limit = SUBSCRIPTION_TIERS[tier]['images_per_month']
-    if user['usage']['images_generated'] >= limit:
+    # Check if user has reached their image limit. Uploads use none of it;
+    # this only spares a full account the processing. Generations reserve
+    # their image atomically
+    if quota.remaining(user) <= 0:
         return jsonify({'error': 'Monthly image limit reached'}), 403
     
-    # Check if file is in request
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    # Stream the file to staging, hashing it and checking its image header
+    # on the way; bad uploads are refused before the rest of the body is read
+    try:
+        with stage('upload_receive'):
+            file = receive_upload(
+                request.environ,
+                'file',
+                staging_path,
+                max_bytes=app.config['MAX_CONTENT_LENGTH'],
+                max_pixels=app.config['UPLOAD_MAX_PIXELS']
+            )
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
     
-    # Save uploaded file
-    filename = secure_filename(file.filename)
-    unique_filename = f"{uuid.uuid4()}_{filename}"
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-    file.save(file_path)
+    upload = file.stream
+    temp_path, content_hash, size = upload.path, upload.content_hash, upload.size
+    # Named after the detected format, not the client's filename
+    extension = ENCODED_IMAGE_EXTENSIONS[upload.image_format]
     
-    # Process image (background removal)
+    blob = None
     try:
-        processed_path = process_image(file_path)
+        # Identical bytes were uploaded before: share their cutout
+        blob = blob_store.acquire(content_hash)
+        
+        if blob:
+            os.remove(temp_path)
+        else:
+            # Process image (background removal), then store both by content hash
+            original_key = storage_key(app.config['UPLOAD_FOLDER'], f"{content_hash}{extension}")
+            processed_key = process_image(temp_path, original_key)
+            storage.put_file(original_key, temp_path, Image.MIME[upload.image_format])
+            blob = blob_store.register(content_hash, original_key, processed_key, size)
+            
+            # A concurrent upload of the same bytes registered first under
+            # other keys (recorded before uploads were named by format)
+            if blob['original_key'] != original_key:
+                delete_stored_image(original_key)
+                delete_stored_image(processed_key)
         
         # Create image record in MongoDB
         image_record = {
             'owner': email,
-            'original_path': file_path,
-            'processed_path': processed_path,
-            'generated_images': [],
+            'original_key': blob['original_key'],
+            'processed_key': blob['processed_key'],
+            'content_hash': content_hash,
             'created_at': datetime.now()
         }
         
@@ -302,8 +805,35 @@ def upload_image():
         }), 201
     
     except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        if blob:
+            # The last reference takes the stored files with it, as in delete_image
+            released = blob_store.release(content_hash)
+            if released:
+                delete_stored_image(released['original_key'])
+                delete_stored_image(released['processed_key'])
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/processing/status', methods=['GET'])
+@jwt_required()
+def get_processing_status():
+    return jsonify({
+        'processing': processing_pool.stats(),
+        'gemini_clients': gemini_pool.stats(),
+        'gemini_payloads': payload_cache_stats(),
+        'generation_cache': generation_cache.stats(),
+        'thumbnail_cache': thumbnail_cache.stats(),
+        'user_cache': user_cache.stats(),
+        'mongo': mongo.connection.stats()
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint, merged across worker processes"""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
 @app.route('/api/scenes', methods=['GET'])
 @jwt_required()
 def get_scenes():
@@ -317,6 +847,8 @@ def generate_image():
     image_id = data.get('image_id')
     scene = data.get('scene')
     custom_prompt = data.get('custom_prompt', '')
+    # Skip the generation cache when the user wants a new variation
+    new_variation = bool(data.get('new_variation', False))
     
     # Validate inputs
     if not image_id or not scene:
@@ -340,82 +872,114 @@ def generate_image():
     # Get scene prompt
     scene_prompt = SCENE_TEMPLATES.get(scene, custom_prompt)
     
+    # Take one image of the monthly allowance before any work starts;
+    # concurrent requests cannot take more than is left
     try:
-        # Generate image using Gemini
-        generated_path = generate_with_gemini(
-            image_data['processed_path'],
-            scene_prompt
-        )
-        
-        # Create generated image record
+        quota.reserve(email)
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 403
+    
+    # Hand slow generations to the job queue when the client asks for it.
+    # The job gives the image back if it fails
+    if data.get('async'):
         generated_id = str(uuid.uuid4())
-        generated_image = {
-            'id': generated_id,
-            'path': generated_path,
-            'scene': scene,
-            'prompt': scene_prompt,
-            'created_at': datetime.now()
-        }
-        
-        # Update image record in MongoDB
-        result = images_collection.update_one(
-            {'_id': object_id},
-            {'$push': {'generated_images': generated_image}}
-        )
-        
-        # Increment user's images generated count
-        users_collection.update_one(
-            {'email': email},
-            {'$inc': {'usage.images_generated': 1}}
-        )
-        
-        # Get updated user info for remaining images
-        user = users_collection.find_one({'email': email})
+        try:
+            job_id = job_queue.enqueue('generate', email, {
+                'image_id': image_id,
+                'scene': scene,
+                'scene_prompt': scene_prompt,
+                'generated_id': generated_id,
+                'new_variation': new_variation
+            })
+        except Exception as e:
+            quota.refund(email)
+            return jsonify({'error': str(e)}), 500
         
         return jsonify({
+            'job_id': job_id,
             'generated_id': generated_id,
-            'message': 'Image generated successfully',
-            'remaining_images': SUBSCRIPTION_TIERS[user['subscription']['tier']]['images_per_month'] - user['usage']['images_generated']
-        }), 200
+            'status': 'queued',
+            'status_url': f"/api/jobs/{job_id}"
+        }), 202
+    
+    try:
+        result = create_generated_image(
+            email,
+            object_id,
+            image_keys(image_data)[1],
+            scene,
+            scene_prompt,
+            use_cache=not new_variation
+        )
+        result['message'] = 'Image generated successfully'
+        
+        return jsonify(result), 200
     
     except Exception as e:
+        quota.refund(email)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_job(job_id):
+    email = get_jwt_identity()
+    
+    job = job_queue.get(job_id, email)
+    
+    if not job:
+        return jsonify({'error': 'Job not found or access denied'}), 404
+    
+    return jsonify({'job': job}), 200
+
 @app.route('/api/images', methods=['GET'])
 @jwt_required()
 def get_images():
     email = get_jwt_identity()
     
-    # Collect all images owned by the user from MongoDB
-    user_images = []
-    cursor = images_collection.find({'owner': email})
-    
-    for image_data in cursor:
-        # Convert MongoDB document to Python dictionary
-        image_info = {
-            'id': str(image_data['_id']),
-            'created_at': image_data['created_at'].isoformat(),
-            'generated_images': []
-        }
-        
-        # Add URLs to generated images
-        for gen_img in image_data.get('generated_images', []):
-            gen_img_copy = gen_img.copy()
-            # Convert datetime to string
-            if isinstance(gen_img_copy.get('created_at'), datetime):
-                gen_img_copy['created_at'] = gen_img_copy['created_at'].isoformat()
-                
-            gen_filename = os.path.basename(gen_img['path'])
-            gen_img_copy['url'] = f"/processed/{gen_filename}"
-            image_info['generated_images'].append(gen_img_copy)
+    # Pages are opt-in so existing clients still receive every image
+    limit = request.args.get('limit', type=int)
+    max_page_size = app.config['GALLERY_MAX_PAGE_SIZE']
+    if limit is not None and not 1 <= limit <= max_page_size:
+        return jsonify({'error': f'limit must be between 1 and {max_page_size}'}), 400
+    
+    query = {'owner': email}
+    if request.args.get('cursor'):
+        try:
+            query.update(decode_page_cursor(request.args['cursor']))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    # Only the listed fields, newest first along the (owner, created_at) index
+    cursor = images_collection.find(query, GALLERY_PROJECTION).sort([('created_at', -1), ('_id', -1)])
+    if limit:
+        # One extra document tells whether there is a next page
+        cursor = cursor.limit(limit + 1)
+    
+    def generate():
+        # Images are written out as they arrive from MongoDB, a batch at a
+        # time with the generated images of the batch read in one query
+        yield '{"images":['
+        next_cursor = None
+        previous = None
+        count = 0
+        for batch in iter(lambda: list(itertools.islice(cursor, GALLERY_BATCH_SIZE)), []):
+            if limit and count + len(batch) > limit:
+                # The extra image only tells that there is a next page
+                batch = batch[:limit - count]
+                next_cursor = encode_page_cursor(batch[-1] if batch else previous)
             
-            # Debug output
-            print(f"Gallery image - Generated image path: {gen_img['path']}")
-            print(f"Gallery image - Generated image URL: {gen_img_copy['url']}")
-        
-        user_images.append(image_info)
+            generated = generated_store.for_images(batch)
+            for image_data in batch:
+                item = gallery_item(image_data, generated[image_data['_id']])
+                yield (',' if count else '') + json.dumps(item, separators=(',', ':'))
+                count += 1
+                previous = image_data
+            
+            if next_cursor:
+                break
+        yield f'],"next_cursor":{json.dumps(next_cursor)}}}'
     
-    return jsonify({'images': user_images}), 200
+    return Response(stream_with_context(generate()), mimetype='application/json'), 200
 
 @app.route('/api/images/<image_id>', methods=['GET'])
 @jwt_required()
@@ -442,17 +1006,16 @@ def get_image(image_id):
         elif key == 'created_at':
             image_dict[key] = value.isoformat()
         elif key == 'generated_images':
-            # Process each generated image
-            image_dict[key] = []
-            for gen_img in value:
-                gen_img_copy = gen_img.copy()
-                # Convert datetime to string
-                if isinstance(gen_img_copy.get('created_at'), datetime):
-                    gen_img_copy['created_at'] = gen_img_copy['created_at'].isoformat()
-                image_dict[key].append(gen_img_copy)
+            # Listed below, together with those in their own collection
+            continue
+        elif key in ('original_key', 'processed_key'):
+            # Storage keys are reported under the older path names
+            image_dict[key.replace('_key', '_path')] = value
         else:
             image_dict[key] = value
     
+    image_dict['generated_images'] = [generated_image_info(gen_img) for gen_img in generated_store.for_image(image_data)]
+    
     # Add api-friendly paths
     original_filename = os.path.basename(image_dict['original_path'])
     processed_filename = os.path.basename(image_dict['processed_path'])
@@ -486,23 +1049,20 @@ def download_image(image_id, generated_id):
     except:
         return jsonify({'error': 'Invalid image ID format'}), 400
     
-    # Find image in MongoDB
-    image_data = images_collection.find_one({'_id': object_id})
-    
-    if not image_data or image_data['owner'] != email:
-        return jsonify({'error': 'Image not found or access denied'}), 404
-    
-    # Find the generated image
-    generated_image = None
-    for gen_img in image_data.get('generated_images', []):
-        if gen_img['id'] == generated_id:
-            generated_image = gen_img
-            break
+    # Find the generated image by its id, image and owner
+    generated_image = generated_store.get(object_id, generated_id, email)
     
     if not generated_image:
-        return jsonify({'error': 'Generated image not found'}), 404
+        return jsonify({'error': 'Generated image not found or access denied'}), 404
     
-    return send_file(generated_image['path'], as_attachment=True)
+    key = generated_image['key']
+    download_name = os.path.basename(key)
+    
+    # Object stores hand the file out themselves
+    signed = storage.url(key, download_name=download_name)
+    if signed:
+        return redirect(signed[0])
+    return send_file(storage.local_path(key), as_attachment=True, download_name=download_name)
 
 @app.route('/api/images/<image_id>', methods=['DELETE'])
 @jwt_required()
@@ -521,20 +1081,24 @@ def delete_image(image_id):
     if not image_data or image_data['owner'] != email:
         return jsonify({'error': 'Image not found or access denied'}), 404
     
+    generated_images = generated_store.for_image(image_data)
+    
     # Delete physical files
     try:
-        # Original image
-        if os.path.exists(image_data['original_path']):
-            os.remove(image_data['original_path'])
-            
-        # Processed image
-        if os.path.exists(image_data['processed_path']):
-            os.remove(image_data['processed_path'])
+        # Original and processed images are shared by identical uploads and
+        # only go away with the last reference
+        if image_data.get('content_hash'):
+            blob = blob_store.release(image_data['content_hash'])
+            shared_keys = [blob['original_key'], blob['processed_key']] if blob else []
+        else:
+            shared_keys = list(image_keys(image_data))
+        
+        for key in shared_keys:
+            delete_stored_image(key)
             
         # Generated images
-        for gen_img in image_data.get('generated_images', []):
-            if os.path.exists(gen_img['path']):
-                os.remove(gen_img['path'])
+        for gen_img in generated_images:
+            delete_stored_image(gen_img['key'])
     except Exception as e:
         print(f"Error deleting files: {e}")
     
@@ -544,6 +1108,9 @@ def delete_image(image_id):
     if result.deleted_count == 0:
         return jsonify({'error': 'Failed to delete image'}), 500
     
+    generated_store.remove_all(object_id)
+    dashboard_stats.record_scenes([gen_img['scene'] for gen_img in generated_images], -1)
+    
     return jsonify({'message': 'Image deleted successfully'}), 200
 
 @app.route('/api/images/<image_id>/generated/<generated_id>', methods=['DELETE'])
@@ -557,88 +1124,189 @@ def delete_generated_image(image_id, generated_id):
     except:
         return jsonify({'error': 'Invalid image ID format'}), 400
     
-    # Find image in MongoDB
-    image_data = images_collection.find_one({'_id': object_id})
-    
-    if not image_data or image_data['owner'] != email:
-        return jsonify({'error': 'Image not found or access denied'}), 404
-    
-    # Find the generated image
-    generated_image = None
-    for gen_img in image_data.get('generated_images', []):
-        if gen_img['id'] == generated_id:
-            generated_image = gen_img
-            break
+    # Remove the generated image's record by its id, image and owner
+    generated_image = generated_store.remove(object_id, generated_id, email)
     
     if not generated_image:
-        return jsonify({'error': 'Generated image not found'}), 404
+        return jsonify({'error': 'Generated image not found or access denied'}), 404
+    
+    dashboard_stats.record_scenes([generated_image['scene']], -1)
     
     # Delete physical file
     try:
-        if os.path.exists(generated_image['path']):
-            os.remove(generated_image['path'])
+        delete_stored_image(generated_image['key'])
     except Exception as e:
         print(f"Error deleting generated image file: {e}")
     
-    # Update MongoDB record
-    result = images_collection.update_one(
-        {'_id': object_id},
-        {'$pull': {'generated_images': {'id': generated_id}}}
-    )
+    return jsonify({'message': 'Generated image deleted successfully'}), 200
+
+def create_generated_image(email, object_id, processed_key, scene, scene_prompt, generated_id=None, use_cache=True):
+    """
+    Generate a visualization for an image and record it. The caller reserves
+    the image from the user's quota first. Passing a generated_id makes a
+    retried call record at most one entry.
+    """
+    generated_id = generated_id or str(uuid.uuid4())
+    
+    # Generate image using Gemini
+    generated_key = generate_with_gemini(processed_key, scene_prompt, use_cache=use_cache)
+    
+    # Create generated image record
+    generated_image = {
+        'id': generated_id,
+        'key': generated_key,
+        'scene': scene,
+        'prompt': scene_prompt,
+        'created_at': datetime.now()
+    }
     
-    if result.modified_count == 0:
-        return jsonify({'error': 'Failed to delete generated image'}), 500
+    # Record it; a retried call finds the entry of its earlier attempt
+    if generated_store.add(object_id, email, generated_image):
+        # Deleted while generating; the caller refunds the reservation
+        if not images_collection.find_one({'_id': object_id}, {'_id': 1}):
+            generated_store.remove(object_id, generated_id, email)
+            raise Exception("Image not found")
+        
+        dashboard_stats.record_scenes([scene])
+        
+        # Re-encoding is kept off the request path
+        target_format = app.config['GENERATED_IMAGE_FORMAT']
+        if target_format and os.path.splitext(generated_key)[1] != ENCODED_IMAGE_EXTENSIONS.get(target_format):
+            job_queue.enqueue('convert', email, {
+                'image_id': str(object_id),
+                'generated_id': generated_id,
+                'format': target_format
+            })
+    
+    # The reservation put the updated account in the cache
+    return {
+        'generated_id': generated_id,
+        'remaining_images': quota.remaining(user_cache.get(email))
+    }
+
+def run_generation_job(job):
+    """Job queue handler for asynchronous /api/generate requests"""
+    params = job['params']
+    object_id = ObjectId(params['image_id'])
     
-    return jsonify({'message': 'Generated image deleted successfully'}), 200
+    try:
+        image_data = images_collection.find_one({'_id': object_id, 'owner': job['owner']})
+        if not image_data:
+            raise Exception("Image not found")
+        
+        # A retried job whose earlier attempt already finished must not generate again
+        if generated_store.get(object_id, params['generated_id'], job['owner']):
+            return {
+                'generated_id': params['generated_id'],
+                'remaining_images': quota.remaining(user_cache.get(job['owner']))
+            }
+        
+        return create_generated_image(
+            job['owner'],
+            object_id,
+            image_keys(image_data)[1],
+            params['scene'],
+            params['scene_prompt'],
+            generated_id=params['generated_id'],
+            use_cache=not params.get('new_variation', False)
+        )
+    except Exception:
+        # The job fails for good; give back the image /api/generate reserved
+        quota.refund(job['owner'])
+        raise
 
-# Image processing functions
-def process_image(image_path):
+def abandon_generation_job(job):
     """
-    Process the uploaded image by removing background
-    In a production app, this would use a dedicated background removal service or ML model
+    Job queue handler for generate jobs given up on after too many attempts,
+    which never reach run_generation_job's refund
     """
-    print(f"Processing image: {image_path}")
-    img = Image.open(image_path)
+    params = job['params']
+    # An interrupted attempt may have stored the image before it died
+    if not generated_store.get(ObjectId(params['image_id']), params['generated_id'], job['owner']):
+        quota.refund(job['owner'])
+
+def run_conversion_job(job):
+    """Job queue handler converting a generated image to GENERATED_IMAGE_FORMAT"""
+    params = job['params']
+    object_id = ObjectId(params['image_id'])
+    target_format = params['format']
     
-    # Simple background removal simulation (replace with actual implementation)
-    # Here we're just creating a transparent version, but real implementation
-    # would use segmentation models to isolate the product
-    img = img.convert("RGBA")
-    
-    # Simple transparency around edges (demo only)
-    # In production, use proper background removal service like Remove.bg or ML models
-    datas = img.getdata()
-    newData = []
-    
-    # This is just a simplified demo - real background removal is more complex
-    for item in datas:
-        # If pixel is whitish, make it transparent
-        if item[0] > 240 and item[1] > 240 and item[2] > 240:
-            newData.append((255, 255, 255, 0))
-        else:
-            newData.append(item)
+    generated_image = generated_store.get(object_id, params['generated_id'], job['owner'])
     
-    img.putdata(newData)
+    # Deleted in the meantime, or already converted by an earlier attempt
+    extension = ENCODED_IMAGE_EXTENSIONS[target_format]
+    if not generated_image or generated_image['key'].endswith(extension):
+        return {'converted': False}
     
-    # Save processed image
-    processed_filename = os.path.join(
-        app.config['PROCESSED_FOLDER'], 
-        f"processed_{os.path.basename(image_path)}"
-    )
-    img.save(processed_filename, "PNG")
+    old_key = generated_image['key']
+    new_key = os.path.splitext(old_key)[0] + extension
+    
+    # Encode into staging, then store under the new key
+    temp_path = staging_path(extension)
+    try:
+        with storage.local_copy(old_key) as path, Image.open(path) as img, stage('convert'):
+            save_compact_image(img, temp_path, target_format, app.config['GENERATED_IMAGE_QUALITY'])
+        storage.put_file(new_key, temp_path, Image.MIME.get(target_format))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    converted = generated_store.set_key(params['generated_id'], old_key, new_key)
+    
+    if converted:
+        delete_stored_image(old_key)
+    else:
+        storage.delete(new_key)
     
-    print(f"Saved processed image to: {processed_filename}")
-    return processed_filename
+    return {'converted': converted, 'key': new_key}
 
-def generate_with_gemini(processed_image_path, scene_prompt):
-    """Generate a new image using Google's Gemini API"""
-    print(f"Generating visualization for image: {processed_image_path} with prompt: {scene_prompt}")
+# Image processing functions
+def process_image(image_path, original_key):
+    """
+    Process the uploaded image by removing background and store the cutout
+    next to the original, returning its storage key.
+    In a production app, this would use a dedicated background removal service or ML model
+    """
+    print(f"Processing image: {image_path}")
+    with stage('decode'):
+        img = Image.open(image_path)
+        img.load()
     
-    # Initialize Gemini client with API key
-    client = genai.Client(api_key=app.config['GEMINI_API_KEY'])
+    # Simple background removal simulation (replace with actual implementation)
+    # Whitish pixels become transparent white, everything else keeps its colour
+    # and alpha. In production, use proper background removal service like
+    # Remove.bg or ML models
+    with stage('cutout'):
+        img = processing_pool.remove_white_background(
+            img,
+            threshold=app.config['WHITE_THRESHOLD'],
+            matte=(255, 255, 255),
+            keep_alpha=True,
+            memory_budget=app.config['CUTOUT_MEMORY_BUDGET']
+        )
     
-    # Load the image directly with PIL
-    image = PIL.Image.open(processed_image_path)
+    # Save processed image; the cutout is a PNG whatever the upload was
+    processed_filename = f"processed_{os.path.splitext(os.path.basename(original_key))[0]}.png"
+    processed_key = storage_key(app.config['PROCESSED_FOLDER'], processed_filename)
+    temp_path = staging_path('.png')
+    try:
+        with stage('encode'):
+            img.save(temp_path, "PNG")
+        storage.put_file(processed_key, temp_path, 'image/png')
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    print(f"Saved processed image to: {processed_key}")
+    return processed_key
+
+def generate_with_gemini(processed_key, scene_prompt, use_cache=True):
+    """
+    Generate a new image using Google's Gemini API and return its storage key.
+    Identical requests are answered from the generation cache unless
+    use_cache is False.
+    """
+    print(f"Generating visualization for image: {processed_key} with prompt: {scene_prompt}")
     
     # Create the prompt text
     text_input = (
@@ -646,16 +1314,22 @@ def generate_with_gemini(processed_image_path, scene_prompt):
         f"The product should be the main focus in the scene. "
         f"The lighting should be consistent and the shadows realistic."
     )
+    response_modalities = ['Text', 'Image']
     
-    # Generate image using Gemini image editing
-    try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash-exp-image-generation",
-            contents=[text_input, image],
-            config=types.GenerateContentConfig(
-                response_modalities=['Text', 'Image']
+    def produce(path):
+        # Encoded once per processed image and sent as raw bytes
+        with stage('gemini_input'):
+            image = image_part(processed_image_path, digest=digest)
+        
+        # Borrow a pooled client so the warm connection is reused
+        with gemini_pool.client() as client, gemini_call('gemini_generate_content'):
+            response = client.models.generate_content(
+                model=GEMINI_IMAGE_MODEL,
+                contents=[text_input, image],
+                config=types.GenerateContentConfig(
+                    response_modalities=response_modalities
+                )
             )
-        )
         
         # Extract and save the generated image
         for part in response.candidates[0].content.parts:
@@ -663,44 +1337,76 @@ def generate_with_gemini(processed_image_path, scene_prompt):
                 # Log any text response from the model
                 print(f"Gemini response text: {part.text}")
             elif part.inline_data is not None:
-                # Save the generated image
-                generated_img = Image.open(BytesIO(part.inline_data.data))
-                generated_path = os.path.join(
-                    app.config['PROCESSED_FOLDER'],
-                    f"generated_{uuid.uuid4()}.png"
-                )
-                generated_img.save(generated_path)
-                print(f"Saved generated image to: {generated_path}")
-                return generated_path
+                # Save the returned bytes as they are, checking only the header
+                with stage('output_write'):
+                    sniff_image_format(part.inline_data.data, part.inline_data.mime_type)
+                    with open(path, 'wb') as f:
+                        f.write(part.inline_data.data)
+                return
         
         raise Exception("No image was generated")
+    
+    # The extension follows the format the model returned
+    generated_path = staging_path()
+    
+    # Generate image using Gemini image editing
+    try:
+        with storage.local_copy(processed_key) as processed_image_path:
+            with stage('input_digest'):
+                digest = file_digest(processed_image_path)
+            if use_cache:
+                key = cache_key(
+                    digest,
+                    text_input,
+                    GEMINI_IMAGE_MODEL,
+                    {'response_modalities': response_modalities}
+                )
+                if generation_cache.get_or_create(key, produce, generated_path):
+                    print(f"Reused cached generation for: {processed_key}")
+            else:
+                produce(generated_path)
+        
+        generated_path = add_image_extension(generated_path)
+        extension = os.path.splitext(generated_path)[1]
+        generated_key = storage_key(app.config['PROCESSED_FOLDER'], f"generated_{uuid.uuid4()}{extension}")
+        storage.put_file(generated_key, generated_path, mimetypes.guess_type(generated_path)[0])
+        print(f"Saved generated image to: {generated_key}")
+        return generated_key
             
     except Exception as e:
+        if os.path.exists(generated_path):
+            os.remove(generated_path)
         print(f"Error generating image with Gemini: {str(e)}")
         raise
     
     
 def generate_with_imagen(scene_prompt):
     """Generate a scene using Google's Imagen API"""
-    client = genai.Client()
-    
     try:
-        response = client.models.generate_images(
-            model='imagen-3.0-generate-002',
-            prompt=scene_prompt,
-            config=types.GenerateImagesConfig(
-                number_of_images=1,
+        with gemini_pool.client() as client, gemini_call('imagen_generate_images'):
+            response = client.models.generate_images(
+                model='imagen-3.0-generate-002',
+                prompt=scene_prompt,
+                config=types.GenerateImagesConfig(
+                    number_of_images=1,
+                )
             )
-        )
         
         for generated_image in response.generated_images:
-            image = Image.open(BytesIO(generated_image.image.image_bytes))
-            generated_path = os.path.join(
-                app.config['PROCESSED_FOLDER'],
-                f"scene_{uuid.uuid4()}.png"
-            )
-            image.save(generated_path)
-            return generated_path
+            with stage('output_write'):
+                scene_path = save_encoded_image(
+                    generated_image.image.image_bytes,
+                    generated_image.image.mime_type,
+                    staging_path()
+                )
+            try:
+                scene_key = storage_key(app.config['PROCESSED_FOLDER'], f"scene_{uuid.uuid4()}{os.path.splitext(scene_path)[1]}")
+                storage.put_file(scene_key, scene_path, generated_image.image.mime_type)
+            finally:
+                # put_file consumes the file only when it succeeds
+                if os.path.exists(scene_path):
+                    os.remove(scene_path)
+            return scene_key
         
         raise Exception("No image was generated")
             
@@ -0,0 +1,99 @@
+# blob_store.py
+import logging
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+class BlobStore:
+    """
+    Reference-counted index of uploaded content, keyed by SHA-256 digest.
+    
+    Each blob document records the storage keys of the original bytes and
+    their processed cutout. Image records point at a blob through their content_hash,
+    so identical uploads share one original and one cutout, and the files
+    are deleted only when the last image referencing them is deleted.
+    """
+    
+    def __init__(self, collection):
+        """
+        Args:
+            collection: Mongo collection holding blob documents
+        """
+        self.collection = collection
+    
+    @staticmethod
+    def _with_keys(blob: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Blobs recorded before storage keys hold flat paths, which resolve as local keys."""
+        if blob is not None and 'original_key' not in blob:
+            blob['original_key'] = blob['original_path']
+            blob['processed_key'] = blob['processed_path']
+        return blob
+    
+    def acquire(self, digest: str) -> Optional[Dict[str, Any]]:
+        """
+        Take a reference to an existing blob.
+        
+        Args:
+            digest: SHA-256 hex digest of the content
+        
+        Returns:
+            The blob document, or None if the content has not been seen
+        """
+        return self._with_keys(self.collection.find_one_and_update(
+            {'_id': digest},
+            {'$inc': {'refcount': 1}},
+            return_document=ReturnDocument.AFTER
+        ))
+    
+    def register(self, digest: str, original_key: str, processed_key: str, size: int) -> Dict[str, Any]:
+        """
+        Record newly stored content with one reference.
+        
+        If a concurrent upload of the same bytes registered first, a reference
+        to that blob is taken instead and its document is returned, so callers
+        must use the keys from the result rather than their own.
+        
+        Returns:
+            The blob document now referenced by the caller
+        """
+        blob = {
+            '_id': digest,
+            'original_key': original_key,
+            'processed_key': processed_key,
+            'size': size,
+            'refcount': 1,
+            'created_at': datetime.now()
+        }
+        try:
+            self.collection.insert_one(blob)
+            return blob
+        except DuplicateKeyError:
+            existing = self.acquire(digest)
+            if existing is None:
+                # Released and removed in between; try again as the first owner
+                return self.register(digest, original_key, processed_key, size)
+            return existing
+    
+    def release(self, digest: str) -> Optional[Dict[str, Any]]:
+        """
+        Drop a reference to a blob.
+        
+        Returns:
+            The blob document if that was the last reference and the caller
+            should now delete its files, otherwise None
+        """
+        blob = self.collection.find_one_and_update(
+            {'_id': digest},
+            {'$inc': {'refcount': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob is None or blob['refcount'] > 0:
+            return None
+        
+        # Another upload may have taken a reference since the decrement
+        result = self.collection.delete_one({'_id': digest, 'refcount': {'$lte': 0}})
+        return self._with_keys(blob) if result.deleted_count else None
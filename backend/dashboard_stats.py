@@ -0,0 +1,209 @@
+# dashboard_stats.py
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Seconds the admin dashboard figures are served before they are computed again
+DEFAULT_TTL = 60.0
+
+# Calendar months shown in the registrations chart
+REGISTRATION_MONTHS = 6
+
+# Scenes listed as most used
+TOP_SCENES = 5
+
+
+def _month_key(when: datetime) -> str:
+    return when.strftime('%Y-%m')
+
+
+def _recent_months(now: datetime, count: int) -> List[datetime]:
+    """The last count calendar months up to now, oldest first"""
+    year, month = now.year, now.month
+    months = []
+    for _ in range(count):
+        months.append(datetime(year, month, 1))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months[::-1]
+
+
+class DashboardStats:
+    """
+    Figures for the admin dashboard.
+    
+    User totals and subscription tiers come from one $facet aggregation
+    over the users collection. Scene usage and monthly registrations would
+    need a scan of every image and user, so they are kept as counters in a
+    stats collection, one document per scene or month, incremented by the
+    writes that change them. The result is cached for ttl seconds and
+    reported with the time it was computed.
+    """
+    
+    def __init__(self, db, tiers: Dict[str, Dict[str, Any]], ttl: float = DEFAULT_TTL):
+        """
+        Initialize the stats.
+        
+        Args:
+            db: MongoDB database holding the users, images, generated_images
+                and stats collections
+            tiers: SUBSCRIPTION_TIERS map of tier name to its settings
+            ttl: Seconds a computed result is served
+        """
+        self.users = db.users
+        self.images = db.images
+        self.generated_images = db.generated_images
+        self.collection = db.stats
+        self.tiers = tiers
+        self.ttl = ttl
+        
+        self._lock = threading.Lock()
+        self._cached: Optional[Tuple[float, datetime, Dict[str, Any]]] = None
+    
+    def create_indexes(self) -> None:
+        """Create the counter indexes."""
+        self.collection.create_index([('kind', 1), ('key', 1)], unique=True)
+        self.collection.create_index([('kind', 1), ('count', -1)])
+    
+    def _increment(self, kind: str, counts: Dict[str, int]) -> None:
+        updates = [
+            UpdateOne({'kind': kind, 'key': key}, {'$inc': {'count': delta}}, upsert=True)
+            for key, delta in counts.items() if delta
+        ]
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+    
+    def record_scenes(self, scenes: Iterable[Optional[str]], delta: int = 1) -> None:
+        """
+        Count generated images in or out of the scene usage figures.
+        Images without a scene are not counted, as in rebuild().
+        
+        Args:
+            scenes: Scene of each generated image added or removed
+            delta: 1 for added images, -1 for removed ones
+        """
+        counts = Counter(scene for scene in scenes if scene is not None)
+        self._increment('scene', {scene: count * delta for scene, count in counts.items()})
+    
+    def record_registration(self, created_at: datetime) -> None:
+        """
+        Count a new user in the registrations of their month.
+        
+        Args:
+            created_at: Registration time of the user
+        """
+        self._increment('registrations', {_month_key(created_at): 1})
+    
+    def rebuild(self) -> None:
+        """
+        Recompute every counter from the users and generated images.
+        
+        Safe to run from several processes at once, as each sets the same
+        values. Increments made while it runs may be overwritten.
+        """
+        scene_counts = Counter()
+        for item in self.generated_images.aggregate([
+            {'$group': {'_id': '$scene', 'count': {'$sum': 1}}}
+        ]):
+            scene_counts[item['_id']] += item['count']
+        # Generated images the migration has not moved out of their record yet
+        for item in self.images.aggregate([
+            {'$unwind': '$generated_images'},
+            {'$group': {'_id': '$generated_images.scene', 'count': {'$sum': 1}}}
+        ]):
+            scene_counts[item['_id']] += item['count']
+        scenes = [{'_id': scene, 'count': count} for scene, count in scene_counts.items()]
+        
+        registrations = self.users.aggregate([
+            {'$match': {'created_at': {'$type': 'date'}}},
+            {'$group': {'_id': {'$dateToString': {'format': '%Y-%m', 'date': '$created_at'}}, 'count': {'$sum': 1}}}
+        ])
+        
+        updates = [
+            UpdateOne({'kind': kind, 'key': item['_id']}, {'$set': {'count': item['count']}}, upsert=True)
+            for kind, items in (('scene', scenes), ('registrations', registrations))
+            for item in items if item['_id'] is not None
+        ]
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+        self.collection.update_one(
+            {'kind': 'meta', 'key': 'built'},
+            {'$set': {'at': datetime.now()}},
+            upsert=True
+        )
+        logger.info(f"Rebuilt {len(updates)} dashboard counters")
+    
+    def ensure_built(self) -> None:
+        """Build the counters from existing data unless they have been built."""
+        if not self.collection.find_one({'kind': 'meta', 'key': 'built'}):
+            self.rebuild()
+    
+    def _compute(self) -> Dict[str, Any]:
+        """Read the current figures; four round trips whatever the data size."""
+        facets = next(self.users.aggregate([
+            {'$facet': {
+                'users': [{'$group': {
+                    '_id': None,
+                    'total': {'$sum': 1},
+                    'active': {'$sum': {'$cond': [{'$eq': ['$is_active', True]}, 1, 0]}},
+                    'pending': {'$sum': {'$cond': [{'$eq': ['$pending_activation', True]}, 1, 0]}}
+                }}],
+                'tiers': [{'$group': {'_id': '$subscription.tier', 'count': {'$sum': 1}}}]
+            }}
+        ]))
+        users = facets['users'][0] if facets['users'] else {}
+        tier_counts = {item['_id']: item['count'] for item in facets['tiers']}
+        
+        months = _recent_months(datetime.now(), REGISTRATION_MONTHS)
+        keys = [_month_key(month) for month in months]
+        registrations = {
+            item['key']: item['count']
+            for item in self.collection.find({'kind': 'registrations', 'key': {'$in': keys}})
+        }
+        
+        scenes = self.collection.find(
+            {'kind': 'scene', 'count': {'$gt': 0}}
+        ).sort('count', -1).limit(TOP_SCENES)
+        
+        return {
+            'users': {
+                'total': users.get('total', 0),
+                'active': users.get('active', 0),
+                'pending': users.get('pending', 0)
+            },
+            'subscriptions': {tier: tier_counts.get(tier, 0) for tier in self.tiers},
+            'images': {
+                # From collection metadata, without counting documents
+                'total': self.images.estimated_document_count()
+            },
+            'registrations': {
+                'months': [month.strftime('%b %Y') for month in months],
+                'counts': [registrations.get(key, 0) for key in keys]
+            },
+            'scenes': [{'scene': item['key'], 'count': item['count']} for item in scenes]
+        }
+    
+    def get(self) -> Dict[str, Any]:
+        """
+        Dashboard figures, computed at most once per ttl in this process.
+        
+        Returns:
+            The figures, with generated_at (ISO time they were computed) and
+            age_seconds (how long ago that was)
+        """
+        with self._lock:
+            if self._cached is None or time.monotonic() - self._cached[0] > self.ttl:
+                self._cached = (time.monotonic(), datetime.now(), self._compute())
+            computed, generated_at, figures = self._cached
+        
+        result = dict(figures)
+        result['generated_at'] = generated_at.isoformat()
+        result['age_seconds'] = round(time.monotonic() - computed, 1)
+        return result
+
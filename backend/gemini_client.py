@@ -0,0 +1,296 @@
+# gemini_client.py
+import os
+import logging
+import io
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Iterator, Tuple
+
+from google import genai
+from google.genai import types
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Idle clients kept per pool; busier moments create short-lived extras
+DEFAULT_POOL_SIZE = 8
+
+# Longest side of images sent to the model. The model downscales larger
+# inputs itself, so extra pixels only cost upload bytes
+DEFAULT_INPUT_MAX_SIDE = 1024
+
+# WebP keeps the cutout's alpha at a fraction of the PNG size
+INPUT_FORMAT = "WEBP"
+INPUT_MIME_TYPE = "image/webp"
+INPUT_QUALITY = 90
+
+# Encoded payloads kept in memory per process
+PAYLOAD_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class GeminiClientPool:
+    """
+    Process-wide pool of long-lived google-genai clients.
+    
+    Each client owns an HTTP connection pool, so reusing clients keeps TLS
+    connections warm instead of paying the handshake on every request. A
+    client is checked out by one thread at a time. When every client is
+    busy an extra one is created rather than blocking the caller; it is kept
+    if the pool has room when it comes back, otherwise it is closed.
+    
+    The pool is fork-aware: clients created before a fork share sockets with
+    the parent, so a child process starts again with an empty pool.
+    """
+    
+    def __init__(self, api_key: Optional[str] = None, size: int = DEFAULT_POOL_SIZE):
+        """
+        Initialize the client pool. Clients are created on demand.
+        
+        Args:
+            api_key: Gemini API key (falls back to the SDK's environment lookup)
+            size: Maximum number of idle clients kept for reuse
+        """
+        self.api_key = api_key
+        self.size = size
+        
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self._in_use = 0
+        self._created = 0
+        self._discarded = 0
+    
+    def _new_client(self) -> genai.Client:
+        """Create a new SDK client."""
+        if self.api_key:
+            return genai.Client(api_key=self.api_key)
+        return genai.Client()
+    
+    def _check_fork(self) -> None:
+        """Forget clients inherited from a parent process. Caller holds the lock."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._in_use = 0
+    
+    def acquire(self) -> genai.Client:
+        """Check out a client, creating one if none is idle."""
+        with self._lock:
+            self._check_fork()
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        
+        logger.info("Creating Gemini client")
+        try:
+            return self._new_client()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+            raise
+    
+    def release(self, client: genai.Client) -> None:
+        """Return a client to the pool."""
+        with self._lock:
+            # A client checked out before a fork must not join the child's pool
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if len(self._idle) < self.size:
+                self._idle.append(client)
+                return
+            self._discarded += 1
+        
+        # Older SDK releases have no close(); their connections close on collection
+        close = getattr(client, 'close', None)
+        try:
+            if close is not None:
+                close()
+        except Exception as e:
+            logger.warning(f"Error closing surplus Gemini client: {str(e)}")
+    
+    @contextmanager
+    def client(self) -> Iterator[genai.Client]:
+        """
+        Context manager that checks out a client for the duration of a call.
+        
+        Usage:
+            with pool.client() as client:
+                client.models.generate_content(...)
+        """
+        client = self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Report how many clients (and so keep-alive connections) are in use.
+        
+        Returns:
+            Dictionary of pool statistics
+        """
+        with self._lock:
+            self._check_fork()
+            return {
+                'size': self.size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self._created,
+                'discarded': self._discarded
+            }
+
+
+_pools: Dict[Optional[str], GeminiClientPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_client_pool(api_key: Optional[str] = None, size: int = DEFAULT_POOL_SIZE) -> GeminiClientPool:
+    """
+    Return the process-wide client pool for an API key, creating it on first use.
+    
+    Args:
+        api_key: Gemini API key (None uses the SDK's environment lookup)
+        size: Pool size, only used when the pool is created
+    
+    Returns:
+        Shared GeminiClientPool
+    """
+    with _pools_lock:
+        pool = _pools.get(api_key)
+        if pool is None:
+            pool = _pools[api_key] = GeminiClientPool(api_key, size)
+        return pool
+
+
+def encode_image_payload(image_path: str, max_side: int = DEFAULT_INPUT_MAX_SIDE) -> Tuple[bytes, str]:
+    """
+    Encode an image the way it is sent to the model: no larger than
+    max_side on its longest side, compressed as WebP.
+    
+    Args:
+        image_path: Path to the image file
+        max_side: Longest side in pixels
+    
+    Returns:
+        Tuple of (encoded bytes, mime type)
+    """
+    with Image.open(image_path) as img:
+        # JPEG inputs can decode straight at a reduced scale
+        img.draft(None, (max_side, max_side))
+        img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        
+        output = io.BytesIO()
+        img.save(output, INPUT_FORMAT, quality=INPUT_QUALITY)
+    
+    return output.getvalue(), INPUT_MIME_TYPE
+
+
+class ImagePayloadCache:
+    """
+    In-memory LRU of encoded model inputs, bounded by total bytes.
+    
+    Entries are keyed by the image's content digest when the caller has
+    one, otherwise by path, size and modification time, so a file that is
+    replaced on disk is encoded again.
+    """
+    
+    def __init__(self, max_bytes: int = PAYLOAD_CACHE_BYTES):
+        """
+        Args:
+            max_bytes: Total encoded bytes kept before the oldest are dropped
+        """
+        self.max_bytes = max_bytes
+        
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+    
+    def get(self,
+            image_path: str,
+            max_side: int = DEFAULT_INPUT_MAX_SIDE,
+            digest: Optional[str] = None) -> Tuple[bytes, str]:
+        """
+        Return the encoded payload for an image, encoding it on first use.
+        
+        Returns:
+            Tuple of (encoded bytes, mime type)
+        """
+        if digest:
+            # Stable across temporary copies of the same stored file
+            key = (digest, max_side)
+        else:
+            stat = os.stat(image_path)
+            key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns, max_side)
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry
+            self._misses += 1
+        
+        entry = encode_image_payload(image_path, max_side)
+        
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._bytes += len(entry[0])
+            while self._bytes > self.max_bytes and self._entries:
+                _, (data, _) = self._entries.popitem(last=False)
+                self._bytes -= len(data)
+        
+        return entry
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Report cache occupancy and hit counters.
+        
+        Returns:
+            Dictionary of cache statistics
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses
+            }
+
+
+_payload_cache = ImagePayloadCache()
+
+
+def image_part(image_path: str,
+               max_side: int = DEFAULT_INPUT_MAX_SIDE,
+               digest: Optional[str] = None) -> types.Part:
+    """
+    Build the request part for an input image from the shared payload cache.
+    
+    The part carries already-encoded bytes and their mime type, so the SDK
+    sends them as-is instead of re-encoding a PIL image on every call.
+    
+    Args:
+        image_path: Path to the image file
+        max_side: Longest side in pixels
+        digest: Content hash of the image, if known, used as the cache key
+    
+    Returns:
+        google-genai Part holding the encoded image
+    """
+    data, mime_type = _payload_cache.get(image_path, max_side, digest)
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+def payload_cache_stats() -> Dict[str, Any]:
+    """Report statistics of the shared payload cache."""
+    return _payload_cache.stats()
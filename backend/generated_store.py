@@ -0,0 +1,225 @@
+# generated_store.py
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Fields of a generated image returned to callers
+ENTRY_PROJECTION = {
+    '_id': 0,
+    'id': 1,
+    'image_id': 1,
+    'key': 1,
+    'scene': 1,
+    'prompt': 1,
+    'created_at': 1
+}
+
+# Image records moved per batch by migrate()
+_MIGRATION_BATCH = 500
+
+
+def _from_embedded(image_data: Dict[str, Any], entry: Dict[str, Any]) -> Dict[str, Any]:
+    """A generated image embedded in an image record, in the collection's form"""
+    return {
+        'id': entry['id'],
+        'image_id': image_data['_id'],
+        # Entries from before storage keys hold the same value under 'path'
+        'key': entry.get('key') or entry['path'],
+        'scene': entry.get('scene'),
+        'prompt': entry.get('prompt'),
+        'created_at': entry.get('created_at')
+    }
+
+
+class GeneratedImageStore:
+    """
+    Generated images, one document each, kept apart from their image record.
+    
+    Image records used to embed their generated images in an unbounded
+    generated_images array, so finding one meant loading and scanning the
+    whole record, and every addition or removal rewrote it. Here each
+    generated image is its own document, indexed by its id, its image and
+    its owner.
+    
+    Records still holding an embedded array are moved over by migrate(),
+    which is safe to run while the app serves requests and from several
+    processes at once. Until it finishes, reads also return the embedded
+    entries, and looking up a single entry moves its record on the spot.
+    """
+    
+    def __init__(self, collection, images_collection):
+        """
+        Initialize the store.
+        
+        Args:
+            collection: Mongo collection holding generated image documents
+            images_collection: Mongo collection holding image records
+        """
+        self.collection = collection
+        self.images = images_collection
+    
+    def create_indexes(self) -> None:
+        """Create the indexes entries are found by."""
+        self.collection.create_index('id', unique=True)
+        self.collection.create_index([('image_id', 1), ('created_at', 1)])
+        self.collection.create_index([('owner', 1), ('created_at', -1)])
+    
+    def add(self, image_id: ObjectId, owner: str, entry: Dict[str, Any]) -> bool:
+        """
+        Record a generated image.
+        
+        Args:
+            image_id: Image record it was generated from
+            owner: Email of the image's owner
+            entry: Fields id, key, scene, prompt and created_at
+        
+        Returns:
+            True if recorded, False if an entry with this id already exists
+        """
+        document = dict(entry, image_id=image_id, owner=owner)
+        try:
+            self.collection.insert_one(document)
+            return True
+        except DuplicateKeyError:
+            return False
+    
+    def get(self, image_id: ObjectId, generated_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        Find one generated image of an owner's image.
+        
+        Returns:
+            The entry, or None if there is none
+        """
+        entry = self.collection.find_one(
+            {'id': generated_id, 'image_id': image_id, 'owner': owner},
+            ENTRY_PROJECTION
+        )
+        if entry is not None:
+            return entry
+        
+        # Not migrated yet: move the record's entries over, then read again
+        image_data = self.images.find_one(
+            {'_id': image_id, 'owner': owner, 'generated_images.id': generated_id},
+            {'owner': 1, 'generated_images': 1}
+        )
+        if image_data is None:
+            return None
+        self._migrate_record(image_data)
+        return self.collection.find_one({'id': generated_id, 'image_id': image_id}, ENTRY_PROJECTION)
+    
+    def for_images(self, images: Iterable[Dict[str, Any]]) -> Dict[ObjectId, List[Dict[str, Any]]]:
+        """
+        Generated images of several image records, oldest first, in one query.
+        
+        Args:
+            images: Image records; any embedded generated_images are included
+        
+        Returns:
+            Map of image _id to its entries
+        """
+        entries = {}
+        for image_data in images:
+            entries[image_data['_id']] = [
+                _from_embedded(image_data, entry) for entry in image_data.get('generated_images', [])
+            ]
+        if not entries:
+            return entries
+        
+        # An entry being migrated can briefly be in both places
+        embedded_ids = {entry['id'] for listed in entries.values() for entry in listed}
+        cursor = self.collection.find(
+            {'image_id': {'$in': list(entries)}},
+            ENTRY_PROJECTION
+        ).sort([('image_id', 1), ('created_at', 1)])
+        for entry in cursor:
+            if entry['id'] not in embedded_ids:
+                entries[entry['image_id']].append(entry)
+        
+        for listed in entries.values():
+            listed.sort(key=lambda item: item['created_at'] or datetime.min)
+        return entries
+    
+    def for_image(self, image_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Generated images of one image record, oldest first"""
+        return self.for_images([image_data])[image_data['_id']]
+    
+    def set_key(self, generated_id: str, old_key: str, new_key: str) -> bool:
+        """
+        Point a generated image at a new storage key if it still has old_key.
+        
+        Returns:
+            True if the entry was updated
+        """
+        result = self.collection.update_one(
+            {'id': generated_id, 'key': old_key},
+            {'$set': {'key': new_key}}
+        )
+        return bool(result.modified_count)
+    
+    def remove(self, image_id: ObjectId, generated_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        Delete one generated image of an owner's image.
+        
+        Returns:
+            The deleted entry, or None if there was none
+        """
+        query = {'id': generated_id, 'image_id': image_id, 'owner': owner}
+        entry = self.collection.find_one_and_delete(query, projection=ENTRY_PROJECTION)
+        # Possibly still embedded: get() moves it over
+        if entry is None and self.get(image_id, generated_id, owner) is not None:
+            entry = self.collection.find_one_and_delete(query, projection=ENTRY_PROJECTION)
+        return entry
+    
+    def remove_all(self, image_id: ObjectId) -> None:
+        """Delete every generated image of an image record."""
+        self.collection.delete_many({'image_id': image_id})
+    
+    def _migrate_record(self, image_data: Dict[str, Any]) -> int:
+        """Move one record's embedded entries into the collection."""
+        embedded = image_data.get('generated_images', [])
+        if not embedded:
+            return 0
+        
+        # Upserts keyed by id make a repeated or concurrent move harmless
+        updates = []
+        for entry in embedded:
+            document = _from_embedded(image_data, entry)
+            document['owner'] = image_data['owner']
+            updates.append(UpdateOne({'id': document.pop('id')}, {'$setOnInsert': document}, upsert=True))
+        self.collection.bulk_write(updates, ordered=False)
+        
+        # Only the moved entries are pulled, so entries pushed in the
+        # meantime by a server still on the old layout stay for the next run
+        self.images.update_one(
+            {'_id': image_data['_id']},
+            {'$pull': {'generated_images': {'id': {'$in': [entry['id'] for entry in embedded]}}}}
+        )
+        return len(embedded)
+    
+    def migrate(self) -> int:
+        """
+        Move all embedded generated images into the collection.
+        
+        Returns:
+            Number of entries moved
+        """
+        moved = 0
+        while True:
+            batch = list(self.images.find(
+                {'generated_images.0': {'$exists': True}},
+                {'owner': 1, 'generated_images': 1}
+            ).limit(_MIGRATION_BATCH))
+            if not batch:
+                break
+            for image_data in batch:
+                moved += self._migrate_record(image_data)
+        
+        if moved:
+            logger.info(f"Moved {moved} generated images into their own collection")
+        return moved
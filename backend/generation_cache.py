@@ -0,0 +1,223 @@
+# generation_cache.py
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import uuid
+from concurrent.futures import Future
+from typing import Callable, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the size- and age-based eviction of cached outputs
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+# Bytes read per step when hashing an input image
+_HASH_CHUNK_SIZE = 64 * 1024
+
+
+def file_digest(path: str) -> str:
+    """
+    SHA-256 hex digest of a file's contents.
+    
+    Args:
+        path: Path to the file
+    
+    Returns:
+        Hex digest string
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(image_digest: str, prompt: str, model: str, options: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Build the cache key for a generation request.
+    
+    Args:
+        image_digest: file_digest() of the input (processed) image
+        prompt: Final prompt text sent to the model
+        model: Model name
+        options: JSON-serializable generation options
+    
+    Returns:
+        Hex digest identifying the request
+    """
+    request_id = json.dumps({
+        'image': image_digest,
+        'prompt': prompt,
+        'model': model,
+        'options': options or {}
+    }, sort_keys=True)
+    return hashlib.sha256(request_id.encode('utf-8')).hexdigest()
+
+
+class GenerationCache:
+    """
+    On-disk cache of generated images with single-flight coalescing.
+    
+    Outputs are stored in a directory as one file per key, so every worker
+    process on the host shares the cache. Entries expire after max_age
+    seconds, and the least recently used entries are evicted once the
+    directory grows past max_bytes. Callers never receive the cached file
+    itself, only a link or copy of it, so eviction cannot pull a file out
+    from under an image record.
+    
+    Concurrent misses for the same key within a process wait for the first
+    caller's result instead of starting their own generation.
+    """
+    
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES, max_age: float = DEFAULT_MAX_AGE):
+        """
+        Initialize the cache.
+        
+        Args:
+            directory: Folder holding cached outputs (created if missing)
+            max_bytes: Total size above which the oldest entries are evicted
+            max_age: Seconds an entry stays valid after it was last used
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0
+        }
+    
+    def _entry_path(self, key: str) -> str:
+        # Stored without extension; outputs keep whatever format the model returned
+        return os.path.join(self.directory, key)
+    
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+    
+    def _copy_out(self, key: str, dest_path: str) -> bool:
+        """Link or copy a fresh entry to dest_path. Returns False if there is none."""
+        path = self._entry_path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_atime > self.max_age:
+                return False
+            # Refresh the last-use time so eviction is least-recently-used.
+            # The mtime is kept: image records link to this file and their
+            # ETag and Last-Modified headers derive from it
+            os.utime(path, (time.time(), stat.st_mtime))
+            try:
+                os.link(path, dest_path)
+            except OSError:
+                # Hard links need the same filesystem
+                shutil.copyfile(path, dest_path)
+            return True
+        except FileNotFoundError:
+            return False
+    
+    def get_or_create(self, key: str, produce: Callable[[str], None], dest_path: str) -> bool:
+        """
+        Write the output for key to dest_path, generating it only on a miss.
+        
+        Args:
+            key: Cache key from cache_key()
+            produce: Function that writes a new output to the path it is given
+            dest_path: Where the caller wants its own copy of the output
+        
+        Returns:
+            True if the output came from the cache or another caller's
+            in-flight generation, False if produce was called
+        """
+        if self._copy_out(key, dest_path):
+            self._count('hits')
+            return True
+        
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        
+        if not leader:
+            # Share the in-flight call, including its failure
+            future.result()
+            if self._copy_out(key, dest_path):
+                self._count('coalesced')
+                return True
+            # Evicted already; fall through to a generation of our own
+            produce(dest_path)
+            self._count('misses')
+            return False
+        
+        self._count('misses')
+        entry_path = self._entry_path(key)
+        temp_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            produce(temp_path)
+            os.replace(temp_path, entry_path)
+            future.set_result(entry_path)
+        except BaseException as e:
+            future.set_exception(e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        
+        if not self._copy_out(key, dest_path):
+            shutil.copyfile(entry_path, dest_path)
+        self.evict()
+        return False
+    
+    def evict(self) -> None:
+        """Remove expired entries, then the least recently used ones over max_bytes."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+        
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for last_used, size, path in entries:
+            if now - last_used <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._count('evictions')
+            except FileNotFoundError:
+                pass
+            total -= size
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Report hit, miss and eviction counters.
+        
+        Returns:
+            Dictionary of cache statistics
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._in_flight)
+        
+        stats.update({
+            'max_bytes': self.max_bytes,
+            'max_age': self.max_age
+        })
+        return stats
@@ -0,0 +1,19 @@
+# gunicorn.conf.py
+# Loaded automatically by gunicorn when started from this directory
+import os
+import shutil
+
+
+def on_starting(server):
+    # Metric files left by a previous run would be added to this run's totals
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges such as queue_depth
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -3,18 +3,377 @@ import os
 import io
 import uuid
 import base64
-from typing import Tuple, Optional, Dict, Any, List
+from typing import Tuple, Optional, Dict, Any, List, BinaryIO, Union, TYPE_CHECKING
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, Future
 
 import numpy as np
 from PIL import Image, ImageOps
-from google import genai
 from google.genai import types
 
+from gemini_client import get_client_pool, image_part
+from metrics import stage, gemini_call
+
+if TYPE_CHECKING:
+    from processing_pool import ProcessingPool
+
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Pixels brighter than this on every RGB channel are treated as background
+DEFAULT_WHITE_THRESHOLD = 240
+
+# Working-set cap for a single cutout; larger images are processed in bands
+DEFAULT_CUTOUT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Integer reductions keep at least this multiple of the target resolution
+# for the final LANCZOS resample (same default as Image.thumbnail)
+REDUCING_GAP = 2.0
+
+# Rough bytes of NumPy temporaries per pixel for a whole-frame cutout
+_FULL_FRAME_BYTES_PER_PIXEL = 8
+
+# Working set of a single-threaded cutout, which copies out one band at a time
+_SERIAL_BAND_BYTES = 4 * 1024 * 1024
+
+# File extensions for the encoded formats the image models return
+ENCODED_IMAGE_EXTENSIONS = {
+    'PNG': '.png',
+    'JPEG': '.jpg',
+    'WEBP': '.webp',
+    'GIF': '.gif'
+}
+
+# Thumbnail dimensions clients may ask for, and how the image fills them
+THUMBNAIL_SIZES = (160, 320, 480, 640, 960, 1280)
+THUMBNAIL_FITS = ('contain', 'cover')
+
+# Renditions served to clients that accept them, by mime type
+RENDITION_FORMATS = {
+    'image/webp': ('WEBP', '.webp'),
+    'image/jpeg': ('JPEG', '.jpg')
+}
+
+
+def compute_white_mask(pixels: np.ndarray,
+                       alpha: np.ndarray,
+                       background: Optional[np.ndarray],
+                       threshold: int,
+                       keep_alpha: bool) -> None:
+    """
+    Compute the alpha mask for one band of rows into preallocated buffers.
+    
+    Every step writes through ufunc out= arguments, so the only temporary
+    is one boolean scratch plane the size of the band.
+    
+    Args:
+        pixels: Source pixels (rows x width x 3 or 4), read only
+        alpha: uint8 output plane (rows x width), 0 for background else 255
+        background: Optional uint8 output plane, 1 for background else 0
+        threshold: Channel value above which a pixel counts as white
+        keep_alpha: Combine the source alpha into the foreground
+    """
+    # Build the is-white mask in place as 0/1 bytes
+    is_white = alpha if background is None else background
+    white_view = is_white.view(np.bool_)
+    scratch = np.empty(is_white.shape, dtype=np.bool_)
+    np.greater(pixels[:, :, 0], threshold, out=white_view)
+    for channel in (1, 2):
+        np.greater(pixels[:, :, channel], threshold, out=scratch)
+        np.logical_and(white_view, scratch, out=white_view)
+    
+    # 1 -> 0 and 0 -> 255
+    np.subtract(1, is_white, out=alpha)
+    np.multiply(alpha, 255, out=alpha)
+    
+    if keep_alpha and pixels.shape[2] == 4:
+        np.bitwise_and(alpha, pixels[:, :, 3], out=alpha)
+
+
+def _cut_bands(src: Image.Image,
+               alpha: np.ndarray,
+               background: Optional[np.ndarray],
+               threshold: int,
+               keep_alpha: bool,
+               memory_budget: int,
+               max_workers: Optional[int]) -> None:
+    """
+    Band-by-band mask computation, so the pixels are never copied out whole.
+    
+    Each band is cropped from the source and thresholded into its slice of
+    the preallocated mask planes. With more than one worker the bands run on
+    a thread pool: NumPy releases the GIL for the per-band work, and at most
+    max_workers bands are in flight, so the temporaries never exceed
+    memory_budget.
+    """
+    width, height = src.size
+    channels = len(src.getbands())
+    
+    workers = max_workers or os.cpu_count() or 1
+    # Cropped band, its array copy and a boolean scratch plane per pixel
+    bytes_per_row = width * (2 * channels + 1)
+    band_rows = max(1, memory_budget // (workers * bytes_per_row))
+    # Never fewer bands than workers, so one image can use every core
+    band_rows = min(band_rows, -(-height // workers))
+    
+    def process_band(top: int) -> None:
+        bottom = min(top + band_rows, height)
+        band = np.asarray(src.crop((0, top, width, bottom)))
+        compute_white_mask(
+            band,
+            alpha[top:bottom],
+            None if background is None else background[top:bottom],
+            threshold,
+            keep_alpha
+        )
+    
+    if workers == 1:
+        for top in range(0, height, band_rows):
+            process_band(top)
+        return
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first band error, if any
+        list(executor.map(process_band, range(0, height, band_rows)))
+    
+    logger.info(f"Tiled cutout of {width}x{height} image in {band_rows}-row bands on {workers} threads")
+
+
+def attach_white_mask(img: Image.Image,
+                      alpha: np.ndarray,
+                      background: Optional[np.ndarray],
+                      matte: Optional[Tuple[int, int, int]]) -> Image.Image:
+    """
+    Attach a mask from compute_white_mask to an RGB or RGBA image in place.
+    
+    Args:
+        img: RGB or RGBA PIL Image object, modified in place
+        alpha: uint8 alpha plane (height x width)
+        background: uint8 background plane, required when matte is given
+        matte: Optional RGB colour written into background pixels
+        
+    Returns:
+        The same image, now RGBA
+    """
+    img.putalpha(Image.frombuffer("L", img.size, alpha, "raw", "L", 0, 1))
+    
+    if matte is not None:
+        # A bilevel mask lets paste copy the matte instead of blending it
+        img.paste(
+            tuple(matte) + (0,),
+            mask=Image.frombuffer("1", img.size, background, "raw", "1;8", 0, 1)
+        )
+    
+    return img
+
+
+def remove_white_background(img: Image.Image,
+                            threshold: int = DEFAULT_WHITE_THRESHOLD,
+                            matte: Optional[Tuple[int, int, int]] = None,
+                            keep_alpha: bool = False,
+                            memory_budget: Optional[int] = None,
+                            max_workers: Optional[int] = None) -> Image.Image:
+    """
+    Make near-white background pixels transparent using vectorized thresholding.
+    
+    This is the shared cutout engine used by both the Flask upload route and
+    ImageProcessor. A pixel is background when r, g and b are all greater
+    than the threshold.
+    
+    The mask is computed into a preallocated uint8 plane and attached with
+    Image.putalpha, so the colour planes are never copied into a new RGBA
+    array; the pixels are read one band of rows at a time. RGB and RGBA
+    images are modified in place and returned; other modes are converted to
+    RGBA first.
+    
+    Args:
+        img: PIL Image object in any mode
+        threshold: Channel value above which a pixel counts as white
+        matte: Optional RGB colour written into background pixels
+        keep_alpha: Keep the source alpha for foreground pixels instead of
+            making them fully opaque
+        memory_budget: Optional cap in bytes for working memory. Images whose
+            whole-frame cutout would exceed it are processed on a thread
+            pool; the output is identical either way
+        max_workers: Threads used for banded processing (defaults to CPU count)
+        
+    Returns:
+        RGBA PIL Image with transparent background
+    """
+    src = img if img.mode in ("RGB", "RGBA") else img.convert("RGBA")
+    width, height = src.size
+    
+    alpha = np.empty((height, width), dtype=np.uint8)
+    background = np.empty_like(alpha) if matte is not None else None
+    
+    src.load()
+    if memory_budget is not None and width * height * _FULL_FRAME_BYTES_PER_PIXEL > memory_budget:
+        _cut_bands(src, alpha, background, threshold, keep_alpha, memory_budget, max_workers)
+    else:
+        _cut_bands(src, alpha, background, threshold, keep_alpha, _SERIAL_BAND_BYTES, 1)
+    
+    return attach_white_mask(src, alpha, background, matte)
+
+
+def sniff_image_format(data: bytes, mime_type: Optional[str] = None) -> str:
+    """
+    Identify encoded image bytes from their header, without decoding pixels.
+    
+    Args:
+        data: Encoded image bytes
+        mime_type: Mime type reported alongside the bytes, if any
+    
+    Returns:
+        PIL format name, one of ENCODED_IMAGE_EXTENSIONS
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            image_format = img.format
+    except Exception:
+        raise ValueError(f"Model returned data that is not an image (mime type {mime_type})")
+    
+    if image_format not in ENCODED_IMAGE_EXTENSIONS:
+        raise ValueError(f"Unsupported image format returned by model: {image_format}")
+    if mime_type and Image.MIME.get(image_format) != mime_type:
+        logger.warning(f"Model reported {mime_type} but returned {image_format} data")
+    
+    return image_format
+
+
+def save_encoded_image(data: bytes, mime_type: Optional[str], path_stem: str) -> str:
+    """
+    Write already-encoded image bytes to disk as they are.
+    
+    Args:
+        data: Encoded image bytes
+        mime_type: Mime type reported alongside the bytes, if any
+        path_stem: Destination path without extension
+    
+    Returns:
+        Path of the written file, with the extension of its real format
+    """
+    path = path_stem + ENCODED_IMAGE_EXTENSIONS[sniff_image_format(data, mime_type)]
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def add_image_extension(path: str) -> str:
+    """
+    Rename an extensionless image file after the format in its header.
+    
+    Args:
+        path: Path to the image file
+    
+    Returns:
+        New path of the file
+    """
+    with Image.open(path) as img:
+        image_format = img.format
+    
+    new_path = path + ENCODED_IMAGE_EXTENSIONS[image_format]
+    os.replace(path, new_path)
+    return new_path
+
+
+def save_compact_image(img: Image.Image, path: str, image_format: str, quality: int) -> None:
+    """
+    Encode an image with the settings used for stored and served images.
+    
+    Args:
+        img: PIL Image object
+        path: Destination path
+        image_format: PIL format name (WEBP, JPEG or PNG)
+        quality: Encoding level for lossy formats, 1-100
+    """
+    if image_format == 'WEBP':
+        img.save(path, 'WEBP', quality=quality, method=4)
+    elif image_format == 'JPEG':
+        # Progressive scans render a usable preview before the download ends
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.save(path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        img.save(path, image_format)
+
+
+def _webp_transparency(header: bytes) -> Optional[bool]:
+    """
+    Whether a WebP file has an alpha channel, read from its first chunk; None
+    if the data is not WebP. Pillow's WebP plugin decodes the whole file just
+    to open it.
+    """
+    if len(header) < 25 or header[:4] != b'RIFF' or header[8:12] != b'WEBP':
+        return None
+    chunk = header[12:16]
+    if chunk == b'VP8 ':
+        return False
+    if chunk == b'VP8L':
+        # alpha_is_used follows the 14-bit width and height
+        return bool(int.from_bytes(header[21:25], 'little') >> 28 & 1)
+    if chunk == b'VP8X':
+        return bool(header[20] & 0x10)
+    return None
+
+
+def probe_image(source: Union[str, BinaryIO]) -> Tuple[Optional[str], bool]:
+    """
+    Read an image file's real type from its header, whatever its extension.
+    Only the header is read, so a file object may hold just the start of the
+    file.
+    
+    Args:
+        source: Path to the image file, or a seekable file object
+    
+    Returns:
+        Tuple of (mime type, whether the image has transparency)
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return probe_image(f)
+    
+    transparent = _webp_transparency(source.read(32))
+    if transparent is not None:
+        return 'image/webp', transparent
+    source.seek(0)
+    
+    with Image.open(source) as img:
+        return Image.MIME.get(img.format), img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+
+
+def make_thumbnail(path: str, width: Optional[int], height: Optional[int], fit: str = 'contain') -> Image.Image:
+    """
+    Decode an image at reduced size for a gallery view. Images are never
+    enlarged.
+    
+    Args:
+        path: Path to the image file
+        width: Box width in pixels, or None to follow the height
+        height: Box height in pixels, or None to follow the width
+        fit: 'contain' to fit inside the box, 'cover' to fill it and crop
+    
+    Returns:
+        Resized PIL Image
+    """
+    img = Image.open(path)
+    source_width, source_height = img.size
+    box = (width or source_width, height or source_height)
+    
+    if fit == 'cover' and width and height:
+        scale = max(width / source_width, height / source_height)
+        if scale >= 1:
+            return img
+        # JPEGs decode straight at the nearest larger scale
+        img.draft(None, (round(source_width * scale), round(source_height * scale)))
+        return ImageOps.fit(img, box, Image.LANCZOS)
+    
+    img.draft(None, box)
+    img.thumbnail(box, Image.LANCZOS, reducing_gap=REDUCING_GAP)
+    return img
+
+
 class ImageProcessor:
     """Handles image processing operations for the product visualization service."""
     
@@ -23,7 +382,10 @@ class ImageProcessor:
                  processed_folder: str,
                  gemini_api_key: str,
                  max_image_size: int = 1500,
-                 min_image_size: int = 500):
+                 min_image_size: int = 500,
+                 white_threshold: int = DEFAULT_WHITE_THRESHOLD,
+                 cutout_memory_budget: Optional[int] = DEFAULT_CUTOUT_MEMORY_BUDGET,
+                 processing_pool: Optional["ProcessingPool"] = None):
         """
         Initialize the image processor.
         
@@ -33,19 +395,26 @@ class ImageProcessor:
             gemini_api_key: Google Gemini API key
             max_image_size: Maximum dimension for images (width or height)
             min_image_size: Minimum dimension for images (width or height)
+            white_threshold: Channel value above which a pixel counts as background
+            cutout_memory_budget: Working-memory cap in bytes for background
+                removal; larger images are processed in bands (None disables)
+            processing_pool: Optional ProcessingPool to run background removal
+                in worker processes instead of the calling thread
         """
         self.upload_folder = upload_folder
         self.processed_folder = processed_folder
         self.max_image_size = max_image_size
         self.min_image_size = min_image_size
+        self.white_threshold = white_threshold
+        self.cutout_memory_budget = cutout_memory_budget
+        self.processing_pool = processing_pool
         
         # Ensure directories exist
         os.makedirs(upload_folder, exist_ok=True)
         os.makedirs(processed_folder, exist_ok=True)
         
-        # Initialize Google Gemini API client
-        genai.configure(api_key=gemini_api_key)
-        self.gemini_client = genai.Client()
+        # Share the process-wide Gemini client pool
+        self.gemini_pool = get_client_pool(gemini_api_key)
 
     def save_upload(self, file) -> Tuple[str, str]:
         """
@@ -80,22 +449,33 @@ class ImageProcessor:
             Path to the processed image with transparent background
         """
         try:
-            # Load image
-            img = Image.open(image_path).convert("RGBA")
-            
+            # Read only the header, then decode at close to the final size
+            with stage('decode'):
+                img = Image.open(image_path)
+                target_size = self._target_size(img.size)
+                self._draft_for_size(img, target_size)
+                img.load()
+                # Pillow resizes palette and bilevel images with nearest
+                # neighbour whatever filter is asked for
+                if img.mode not in ('RGB', 'RGBA', 'L'):
+                    img = img.convert('RGBA')
+
             # Resize if needed
-            img = self._resize_image(img)
+            with stage('resize'):
+                img = self._resize_image(img, target_size)
             
             # Simple background removal
             # In production, use a specialized model or service like Remove.bg
-            processed_img = self._simple_background_removal(img)
+            with stage('cutout'):
+                processed_img = self._simple_background_removal(img)
             
             # Save processed image
             processed_filename = os.path.join(
                 self.processed_folder, 
                 f"processed_{os.path.basename(image_path).split('.')[0]}.png"
             )
-            processed_img.save(processed_filename, "PNG")
+            with stage('encode'):
+                processed_img.save(processed_filename, "PNG")
             
             logger.info(f"Processed image saved to {processed_filename}")
             return processed_filename
@@ -104,37 +484,78 @@ class ImageProcessor:
             logger.error(f"Error removing background: {str(e)}")
             raise
     
-    def _resize_image(self, img: Image.Image) -> Image.Image:
+    def _target_size(self, size: Tuple[int, int]) -> Tuple[int, int]:
         """
-        Resize an image to fit within the maximum dimensions while preserving aspect ratio.
-        Also ensures the image meets minimum size requirements.
+        Work out the final processing size for an image of the given size.
+        
+        Images are scaled down to fit within the maximum dimensions while
+        preserving aspect ratio, then scaled up if they fall below the minimum.
         
         Args:
-            img: PIL Image object
+            size: (width, height) as read from the image header
             
         Returns:
-            Resized PIL Image object
+            Target (width, height)
         """
-        width, height = img.size
+        width, height = size
         
-        # Check if resize is needed
+        # Check if a downscale is needed
         if width > self.max_image_size or height > self.max_image_size:
-            # Calculate the scaling factor
             scale = min(self.max_image_size / width, self.max_image_size / height)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            logger.info(f"Resized image from {width}x{height} to {new_width}x{new_height}")
+            width, height = int(width * scale), int(height * scale)
         
         # Ensure minimum size
-        width, height = img.size
         if width < self.min_image_size or height < self.min_image_size:
-            # Calculate scaling factor to meet minimum size
             scale = max(self.min_image_size / width, self.min_image_size / height)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            logger.info(f"Upscaled small image to {new_width}x{new_height}")
+            width, height = int(width * scale), int(height * scale)
+        
+        return width, height
+    
+    def _draft_for_size(self, img: Image.Image, target_size: Tuple[int, int]) -> None:
+        """
+        Ask the decoder for a reduced-scale decode when shrinking an image.
+        
+        For JPEGs this makes the decoder scale by 1/2, 1/4 or 1/8 in the DCT
+        domain, so pixels that the resize would throw away are never decoded.
+        Other formats ignore the request. Must be called before the image is loaded.
+        
+        Args:
+            img: Unloaded PIL Image object
+            target_size: Final (width, height) the image will be resized to
+        """
+        if target_size[0] >= img.width or target_size[1] >= img.height:
+            return
+        
+        # The decoder never goes below the requested size, so the final
+        # LANCZOS resample always works from at least target resolution
+        original_size = img.size
+        if img.draft(None, target_size) is not None:
+            logger.info(f"Draft decoding {original_size[0]}x{original_size[1]} image at {img.width}x{img.height}")
+    
+    def _resize_image(self, img: Image.Image, target_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+        """
+        Resize an image to fit within the maximum dimensions while preserving aspect ratio.
+        Also ensures the image meets minimum size requirements.
+        
+        Large reductions are done in two stages: a cheap integer Image.reduce
+        down to REDUCING_GAP times the target, then a single LANCZOS resample.
+        
+        Args:
+            img: PIL Image object
+            target_size: Final (width, height); computed from img.size if omitted
+            
+        Returns:
+            Resized PIL Image object
+        """
+        if target_size is None:
+            target_size = self._target_size(img.size)
+        
+        if img.size == target_size:
+            return img
+        
+        width, height = img.size
+        img = img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+        logger.info(f"Resized image from {width}x{height} to {target_size[0]}x{target_size[1]}")
         
         return img
     
@@ -151,29 +572,18 @@ class ImageProcessor:
         Returns:
             PIL Image with transparent background
         """
-        # Convert to numpy array for processing
-        np_img = np.array(img)
-        
-        # Create alpha mask (fully opaque initially)
-        if np_img.shape[2] == 3:  # RGB image
-            alpha = np.ones((np_img.shape[0], np_img.shape[1]), dtype=np.uint8) * 255
-            np_img = np.dstack((np_img, alpha))
-        
-        # Get RGB channels
-        r, g, b, a = np_img[:, :, 0], np_img[:, :, 1], np_img[:, :, 2], np_img[:, :, 3]
-        
-        # Detect likely background pixels (whitish colors)
-        # This is a simplistic approach - real background removal is more complex
-        white_threshold = 240
-        is_white = (r > white_threshold) & (g > white_threshold) & (b > white_threshold)
-        
-        # Create mask
-        np_img[:, :, 3] = np.where(is_white, 0, 255)
-        
-        # Convert back to PIL image
-        result_img = Image.fromarray(np_img)
+        if self.processing_pool is not None:
+            return self.processing_pool.remove_white_background(
+                img,
+                threshold=self.white_threshold,
+                memory_budget=self.cutout_memory_budget or DEFAULT_CUTOUT_MEMORY_BUDGET
+            )
         
-        return result_img
+        return remove_white_background(
+            img,
+            threshold=self.white_threshold,
+            memory_budget=self.cutout_memory_budget
+        )
     
     def generate_visualization(self, 
                               processed_image_path: str, 
@@ -191,12 +601,9 @@ class ImageProcessor:
             Path to the generated image
         """
         try:
-            # Read the processed image
-            with open(processed_image_path, 'rb') as f:
-                image_bytes = f.read()
-            
-            # Convert bytes to PIL Image for Gemini
-            image = Image.open(io.BytesIO(image_bytes))
+            # Right-sized, pre-encoded bytes, prepared once per processed image
+            with stage('gemini_input'):
+                image = image_part(processed_image_path)
             
             # Create a full prompt with instructions for the AI
             text_prompt = self._create_gemini_prompt(scene_prompt, custom_options)
@@ -204,24 +611,26 @@ class ImageProcessor:
             logger.info(f"Generating visualization with prompt: {text_prompt}")
             
             # Call Gemini Image Generation API
-            response = self.gemini_client.models.generate_content(
-                model="gemini-2.0-flash-exp-image-generation",
-                contents=[text_prompt, image],
-                config=types.GenerateContentConfig(
-                    response_modalities=['Text', 'Image']
+            with self.gemini_pool.client() as client, gemini_call('gemini_generate_content'):
+                response = client.models.generate_content(
+                    model="gemini-2.0-flash-exp-image-generation",
+                    contents=[text_prompt, image],
+                    config=types.GenerateContentConfig(
+                        response_modalities=['Text', 'Image']
+                    )
                 )
-            )
             
             # Extract and save the generated image
             generated_path = None
             for part in response.candidates[0].content.parts:
                 if part.inline_data is not None:
-                    generated_img = Image.open(io.BytesIO(part.inline_data.data))
-                    generated_path = os.path.join(
-                        self.processed_folder,
-                        f"generated_{uuid.uuid4()}.png"
-                    )
-                    generated_img.save(generated_path)
+                    # Already encoded by the model; store it as-is
+                    with stage('output_write'):
+                        generated_path = save_encoded_image(
+                            part.inline_data.data,
+                            part.inline_data.mime_type,
+                            os.path.join(self.processed_folder, f"generated_{uuid.uuid4()}")
+                        )
                     logger.info(f"Generated visualization saved to {generated_path}")
                     break
             
@@ -285,23 +694,24 @@ class ImageProcessor:
             logger.info(f"Generating scene with prompt: {scene_prompt}")
             
             # Call Imagen API
-            response = self.gemini_client.models.generate_images(
-                model='imagen-3.0-generate-002',
-                prompt=scene_prompt,
-                config=types.GenerateImagesConfig(
-                    number_of_images=1,
+            with self.gemini_pool.client() as client, gemini_call('imagen_generate_images'):
+                response = client.models.generate_images(
+                    model='imagen-3.0-generate-002',
+                    prompt=scene_prompt,
+                    config=types.GenerateImagesConfig(
+                        number_of_images=1,
+                    )
                 )
-            )
             
             # Save the generated scene
             generated_path = None
             for generated_image in response.generated_images:
-                scene_img = Image.open(io.BytesIO(generated_image.image.image_bytes))
-                generated_path = os.path.join(
-                    self.processed_folder,
-                    f"scene_{uuid.uuid4()}.png"
-                )
-                scene_img.save(generated_path)
+                with stage('output_write'):
+                    generated_path = save_encoded_image(
+                        generated_image.image.image_bytes,
+                        generated_image.image.mime_type,
+                        os.path.join(self.processed_folder, f"scene_{uuid.uuid4()}")
+                    )
                 logger.info(f"Generated scene saved to {generated_path}")
                 break
             
@@ -314,34 +724,63 @@ class ImageProcessor:
             logger.error(f"Error generating scene: {str(e)}")
             raise
     
-    def batch_process(self, image_paths: List[str], scenes: List[str]) -> List[str]:
+    def batch_process(self,
+                      image_paths: List[str],
+                      scenes: List[str],
+                      cutout_workers: Optional[int] = None,
+                      max_in_flight_generations: int = 4) -> List[str]:
         """
         Process multiple images with different scenes in batch.
         
+        The batch is pipelined: background removal runs on a pool of
+        cutout_workers threads (or on the processing pool, if configured), and
+        each finished cutout is handed straight to a second pool that keeps at
+        most max_in_flight_generations Gemini calls open, so CPU work and
+        network waits overlap.
+        
         Args:
             image_paths: List of paths to original images
             scenes: List of scene descriptions (one per image)
+            cutout_workers: Parallel background removals (defaults to CPU count)
+            max_in_flight_generations: Concurrent generation API calls
             
         Returns:
-            List of paths to generated visualizations
+            List of paths to generated visualizations, in input order, with
+            None for items that failed
         """
+        total = len(image_paths)
+        started = time.monotonic()
+        
+        def cutout(i: int, image_path: str, scene: str) -> Future:
+            logger.info(f"Processing batch item {i+1}/{total}")
+            
+            # Remove background
+            processed_path = self.remove_background(image_path)
+            
+            # Queue the visualization behind the in-flight generation limit
+            return generation_executor.submit(self.generate_visualization, processed_path, scene)
+        
         results = []
+        with ThreadPoolExecutor(max_workers=cutout_workers or os.cpu_count() or 1) as cutout_executor, \
+                ThreadPoolExecutor(max_workers=max_in_flight_generations) as generation_executor:
+            cutout_futures = [
+                cutout_executor.submit(cutout, i, image_path, scene)
+                for i, (image_path, scene) in enumerate(zip(image_paths, scenes))
+            ]
+            
+            for i, cutout_future in enumerate(cutout_futures):
+                try:
+                    results.append(cutout_future.result().result())
+                except Exception as e:
+                    logger.error(f"Error processing batch item {i+1}: {str(e)}")
+                    results.append(None)
         
-        for i, (image_path, scene) in enumerate(zip(image_paths, scenes)):
-            try:
-                logger.info(f"Processing batch item {i+1}/{len(image_paths)}")
-                
-                # Remove background
-                processed_path = self.remove_background(image_path)
-                
-                # Generate visualization
-                generated_path = self.generate_visualization(processed_path, scene)
-                
-                results.append(generated_path)
-                
-            except Exception as e:
-                logger.error(f"Error processing batch item {i+1}: {str(e)}")
-                results.append(None)
+        elapsed = time.monotonic() - started
+        failed = results.count(None)
+        logger.info(
+            f"Batch of {len(results)} items finished in {elapsed:.1f}s "
+            f"({len(results) / elapsed * 60 if elapsed else 0:.1f} items/min, {failed} failed)"
+        )
         
         return results
 
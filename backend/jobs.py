@@ -0,0 +1,214 @@
+# jobs.py
+import os
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Any, Optional
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Runs slow work such as Gemini generation in background threads.
+    
+    Jobs are stored in a Mongo collection and claimed with an atomic
+    find_one_and_update, so any web worker can pick up a job, and a job left
+    running by a worker that died is claimed again once its lease expires.
+    A job claimed more than max_attempts times is marked failed without
+    running its handler; its type's abandon handler, if any, then undoes
+    what enqueuing it took, such as reserved quota.
+    """
+    
+    def __init__(self,
+                 collection,
+                 handlers: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]],
+                 max_workers: int = 4,
+                 lease_seconds: int = 300,
+                 poll_interval: float = 5.0,
+                 max_attempts: int = 3,
+                 abandon_handlers: Optional[Dict[str, Callable[[Dict[str, Any]], None]]] = None):
+        """
+        Initialize the job queue. Worker threads start on first use.
+        
+        Args:
+            collection: Mongo collection holding job documents
+            handlers: Map of job type to a function taking the job document
+                and returning a JSON-serializable result
+            max_workers: Number of worker threads per process
+            lease_seconds: Seconds a claimed job may run before another
+                worker may take it over
+            poll_interval: Seconds between polls for jobs queued elsewhere
+            max_attempts: Claims allowed before a job is marked failed
+            abandon_handlers: Map of job type to a function called with the
+                job document once it is marked failed after max_attempts
+        """
+        self.collection = collection
+        self.handlers = handlers
+        self.max_workers = max_workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.abandon_handlers = abandon_handlers or {}
+        
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+    
+    def start(self) -> None:
+        """Start the worker threads in this process if they are not running."""
+        with self._lock:
+            # Threads do not survive a fork, so start a fresh set per process
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wakeup = threading.Event()
+            for i in range(self.max_workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+        logger.info(f"Started {self.max_workers} job workers in process {self._pid}")
+    
+    def enqueue(self, job_type: str, owner: str, params: Dict[str, Any]) -> str:
+        """
+        Persist a new job and wake a worker.
+        
+        Args:
+            job_type: Key into the handlers map
+            owner: Email of the user who owns the job
+            params: JSON-serializable job parameters
+        
+        Returns:
+            The job id
+        """
+        if job_type not in self.handlers:
+            raise ValueError(f"Unknown job type: {job_type}")
+        
+        now = datetime.now()
+        result = self.collection.insert_one({
+            'type': job_type,
+            'owner': owner,
+            'params': params,
+            'status': 'queued',
+            'attempts': 0,
+            'created_at': now,
+            'updated_at': now
+        })
+        
+        self.start()
+        self._wakeup.set()
+        return str(result.inserted_id)
+    
+    def depths(self) -> Dict[str, int]:
+        """
+        Count jobs waiting to be claimed and jobs being run, across all workers.
+        
+        Returns:
+            Map of status to number of jobs
+        """
+        return {status: self.collection.count_documents({'status': status}) for status in ('queued', 'running')}
+    
+    def get(self, job_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a job owned by the given user.
+        
+        Returns:
+            JSON-serializable job status, or None if not found
+        """
+        try:
+            object_id = ObjectId(job_id)
+        except Exception:
+            return None
+        
+        job = self.collection.find_one({'_id': object_id, 'owner': owner})
+        if not job:
+            return None
+        
+        job_info = {
+            'job_id': str(job['_id']),
+            'type': job['type'],
+            'status': job['status'],
+            'created_at': job['created_at'].isoformat(),
+            'updated_at': job['updated_at'].isoformat()
+        }
+        if job['status'] == 'succeeded':
+            job_info['result'] = job.get('result')
+        elif job['status'] == 'failed':
+            job_info['error'] = job.get('error')
+        
+        return job_info
+    
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Atomically take the oldest queued job, or a running job whose lease expired."""
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {'$or': [
+                {'status': 'queued'},
+                {'status': 'running', 'lease_expires_at': {'$lt': now}}
+            ]},
+            {
+                '$set': {
+                    'status': 'running',
+                    'lease_expires_at': now + timedelta(seconds=self.lease_seconds),
+                    'updated_at': now
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('created_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+    
+    def _finish(self, job: Dict[str, Any], update: Dict[str, Any]) -> bool:
+        """
+        Record a job outcome unless another worker has since claimed it.
+        
+        Returns:
+            Whether the outcome was recorded
+        """
+        update['updated_at'] = datetime.now()
+        result = self.collection.update_one(
+            {'_id': job['_id'], 'status': 'running', 'attempts': job['attempts']},
+            {'$set': update, '$unset': {'lease_expires_at': ''}}
+        )
+        return result.modified_count == 1
+    
+    def _run(self, job: Dict[str, Any]) -> None:
+        """Execute one claimed job and store its result or error."""
+        if job['attempts'] > self.max_attempts:
+            logger.error(f"Job {job['_id']} abandoned after {self.max_attempts} attempts")
+            if not self._finish(job, {'status': 'failed', 'error': 'Job was interrupted too many times'}):
+                return
+            
+            on_abandon = self.abandon_handlers.get(job['type'])
+            if on_abandon:
+                try:
+                    on_abandon(job)
+                except Exception as e:
+                    logger.error(f"Abandon handler of job {job['_id']} failed: {str(e)}")
+            return
+        
+        try:
+            result = self.handlers[job['type']](job)
+            self._finish(job, {'status': 'succeeded', 'result': result})
+            logger.info(f"Job {job['_id']} succeeded")
+        except Exception as e:
+            logger.error(f"Job {job['_id']} failed: {str(e)}")
+            self._finish(job, {'status': 'failed', 'error': str(e)})
+    
+    def _worker(self) -> None:
+        """Worker thread loop: claim and run jobs, sleeping when there are none."""
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error claiming job: {str(e)}")
+                job = None
+            
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            
+            self._run(job)
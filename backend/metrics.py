@@ -0,0 +1,177 @@
+# metrics.py
+import os
+import time
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Set for multi-worker servers such as gunicorn: every process writes its
+# samples to files in this directory and /metrics adds them up
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Latency buckets in seconds, from a small encode up to a slow model call
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = Histogram(
+    'pipeline_stage_seconds',
+    'Time spent in each stage of the image pipeline',
+    ['stage'],
+    buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter(
+    'http_requests_total',
+    'HTTP requests by route and status',
+    ['method', 'route', 'status']
+)
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'HTTP request latency by route',
+    ['method', 'route'],
+    buckets=LATENCY_BUCKETS
+)
+MONGO_SECONDS = Histogram(
+    'mongo_command_seconds',
+    'MongoDB command latency by command',
+    ['command'],
+    buckets=LATENCY_BUCKETS
+)
+MONGO_ERRORS = Counter(
+    'mongo_command_errors_total',
+    'Failed MongoDB commands',
+    ['command']
+)
+GEMINI_ERRORS = Counter(
+    'gemini_errors_total',
+    'Failed Gemini and Imagen API calls by error type',
+    ['operation', 'error']
+)
+# Per-process values, summed over the processes that are still alive
+QUEUE_DEPTH = Gauge(
+    'queue_depth',
+    'Work waiting for a free worker',
+    ['queue'],
+    multiprocess_mode='livesum'
+)
+
+# Gauges read from shared state (such as MongoDB) when /metrics is scraped
+_scrape_gauges: List[Tuple[str, str, str, Callable[[], Dict[str, float]]]] = []
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a block of pipeline work into pipeline_stage_seconds.
+    
+    Args:
+        name: Stage label, e.g. 'decode', 'cutout' or 'encode'
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+@contextmanager
+def gemini_call(operation: str) -> Iterator[None]:
+    """
+    Time a Gemini or Imagen API call as a pipeline stage and count its failures.
+    
+    Args:
+        operation: Stage and operation label, e.g. 'gemini_generate_content'
+    """
+    try:
+        with stage(operation):
+            yield
+    except Exception as e:
+        GEMINI_ERRORS.labels(operation, type(e).__name__).inc()
+        raise
+
+
+def observe_request(method: str, route: str, status: int, seconds: float) -> None:
+    """Record one finished HTTP request."""
+    REQUESTS.labels(method, route, str(status)).inc()
+    REQUEST_SECONDS.labels(method, route).observe(seconds)
+
+
+def add_scrape_gauge(name: str, documentation: str, label: str, read: Callable[[], Dict[str, float]]) -> None:
+    """
+    Register a gauge whose values are read when /metrics is scraped.
+    
+    For state that lives outside the process, such as the job queue in
+    MongoDB, so the value is the same whichever worker answers the scrape.
+    
+    Args:
+        name: Metric name
+        documentation: Help text
+        label: Name of the label the returned keys are reported under
+        read: Function returning a map of label value to current value
+    """
+    _scrape_gauges.append((name, documentation, label, read))
+
+
+class _ScrapeGaugeCollector:
+    """Collects the gauges registered with add_scrape_gauge."""
+    
+    def collect(self):
+        for name, documentation, label, read in _scrape_gauges:
+            family = GaugeMetricFamily(name, documentation, labels=[label])
+            try:
+                for key, value in read().items():
+                    family.add_metric([key], value)
+            except Exception as e:
+                logger.warning(f"Could not read metric {name}: {str(e)}")
+                continue
+            yield family
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command a MongoClient sends into mongo_command_seconds."""
+    
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        MONGO_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+    
+    def failed(self, event):
+        MONGO_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_ERRORS.labels(event.command_name).inc()
+
+
+if not MULTIPROCESS_DIR:
+    REGISTRY.register(_ScrapeGaugeCollector())
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    Render all metrics in the Prometheus text format.
+    
+    With PROMETHEUS_MULTIPROC_DIR set, the samples of every worker process
+    are merged, so any worker can answer the scrape.
+    
+    Returns:
+        Tuple of (body, content type)
+    """
+    if MULTIPROCESS_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(_ScrapeGaugeCollector())
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,156 @@
+# mongo.py
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from pymongo import MongoClient
+
+from metrics import MongoCommandListener
+
+logger = logging.getLogger(__name__)
+
+# Database all of the app's collections live in
+DATABASE_NAME = 'image_visualization'
+
+# Connection pool defaults for each worker process
+DEFAULT_MAX_POOL_SIZE = 50
+DEFAULT_MIN_POOL_SIZE = 0
+DEFAULT_MAX_IDLE_TIME_MS = 300000
+DEFAULT_CONNECT_TIMEOUT_MS = 5000
+DEFAULT_SERVER_SELECTION_TIMEOUT_MS = 10000
+# 0 waits as long as the server takes, as index builds in migrations can
+DEFAULT_SOCKET_TIMEOUT_MS = 0
+# zlib needs no extra package; zstd and snappy need zstandard and python-snappy
+DEFAULT_COMPRESSORS = 'zlib'
+
+
+class MongoConnection:
+    """
+    Process-wide MongoDB client shared by the app and its blueprints.
+    
+    Nothing connects when the app is imported: the client is created on
+    first use, with connect=False so even then the connection pool fills
+    as requests need it. The connection is fork-aware: a client created
+    before a fork shares sockets with the parent, so a child process
+    creates its own.
+    
+    Modules hold collections from collection(), which resolve to the
+    current process's client on every use and can be created before the
+    connection is configured.
+    """
+    
+    def __init__(self, database: str = DATABASE_NAME):
+        """
+        Initialize an unconfigured connection.
+        
+        Args:
+            database: Name of the database collections are taken from
+        """
+        self.database_name = database
+        
+        self._lock = threading.Lock()
+        self._uri = None
+        self._options: Dict[str, Any] = {}
+        self._client: Optional[MongoClient] = None
+        self._pid = None
+    
+    def configure(self, uri: str, **options) -> None:
+        """
+        Set the server and client options used from the next client on.
+        
+        Args:
+            uri: MongoDB connection string
+            **options: MongoClient keyword options such as maxPoolSize
+        """
+        with self._lock:
+            self._uri = uri
+            self._options = options
+            self._client = None
+            self._pid = None
+    
+    @property
+    def client(self) -> MongoClient:
+        """This process's client, created on first use."""
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        
+        with self._lock:
+            # Inherited from a parent process, or not created yet
+            if self._client is None or self._pid != os.getpid():
+                if self._uri is None:
+                    raise RuntimeError("MongoDB connection is not configured")
+                # Command timings feed the mongo_command_seconds histogram
+                self._client = MongoClient(
+                    self._uri,
+                    connect=False,
+                    event_listeners=[MongoCommandListener()],
+                    **self._options
+                )
+                self._pid = os.getpid()
+                logger.info(f"Created MongoDB client in process {self._pid}")
+            return self._client
+    
+    def collection(self, name: str) -> 'LazyCollection':
+        """A collection of the app's database, resolved when used."""
+        return LazyCollection(self, name)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Client state of this process."""
+        return {
+            'client_created': self._client is not None and self._pid == os.getpid(),
+            'max_pool_size': self._options.get('maxPoolSize'),
+            'min_pool_size': self._options.get('minPoolSize'),
+            'compressors': self._options.get('compressors')
+        }
+
+
+class LazyCollection:
+    """
+    Stand-in for a collection that looks up the real one on each use.
+    
+    Attribute access is forwarded to the collection on the connection's
+    current client, so a handle kept since import keeps working after a
+    fork. The resolved collection is reused while the client stays the same.
+    """
+    
+    def __init__(self, connection: MongoConnection, name: str):
+        self.connection = connection
+        self.name = name
+        self._resolved = None
+    
+    def resolve(self):
+        """The collection on the current process's client."""
+        client = self.connection.client
+        resolved = self._resolved
+        if resolved is None or resolved[0] is not client:
+            resolved = (client, client[self.connection.database_name][self.name])
+            self._resolved = resolved
+        return resolved[1]
+    
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+    
+    def __repr__(self):
+        return f"LazyCollection({self.connection.database_name}.{self.name})"
+
+
+class LazyDatabase:
+    """Database stand-in whose attributes are LazyCollections."""
+    
+    def __init__(self, connection: MongoConnection):
+        self.connection = connection
+    
+    def __getattr__(self, name: str) -> LazyCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.connection.collection(name)
+    
+    def __getitem__(self, name: str) -> LazyCollection:
+        return self.connection.collection(name)
+
+
+# Shared by app.py and the admin blueprint; app.py configures it
+connection = MongoConnection()
+database = LazyDatabase(connection)
@@ -0,0 +1,305 @@
+# processing_pool.py
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Tuple, Optional, Dict, Any
+
+import numpy as np
+from PIL import Image
+
+from image_utils import (
+    compute_white_mask,
+    attach_white_mask,
+    DEFAULT_WHITE_THRESHOLD,
+    DEFAULT_CUTOUT_MEMORY_BUDGET
+)
+from metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Rows copied into shared memory per step, keeps the copy's temporaries small
+_COPY_BAND_BYTES = 4 * 1024 * 1024
+
+
+class ProcessingError(Exception):
+    """Raised when a job could not be completed by the processing pool."""
+
+
+class ProcessingTimeout(ProcessingError):
+    """Raised when a job did not finish within the pool timeout."""
+
+
+def _cut_shared(name: str,
+                shape: Tuple[int, int, int],
+                threshold: int,
+                keep_alpha: bool,
+                with_background: bool,
+                memory_budget: int) -> None:
+    """
+    Worker entry point: compute the white-background mask of a shared image.
+    
+    The segment holds the decoded pixels followed by the alpha plane and,
+    when with_background is set, the background plane. The mask planes are
+    written in place, so nothing but this call's arguments is pickled.
+    """
+    # Workers share the parent's resource tracker, which unlinks the segment
+    # if the parent dies before it can
+    segment = shared_memory.SharedMemory(name=name)
+    pixels = alpha = background = None
+    try:
+        height, width, channels = shape
+        plane = height * width
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=segment.buf)
+        alpha = np.ndarray((height, width), dtype=np.uint8, buffer=segment.buf, offset=plane * channels)
+        if with_background:
+            background = np.ndarray((height, width), dtype=np.uint8, buffer=segment.buf, offset=plane * (channels + 1))
+        
+        # The boolean scratch plane, one byte per pixel, is the only temporary
+        band_rows = max(1, memory_budget // width)
+        for top in range(0, height, band_rows):
+            bottom = min(top + band_rows, height)
+            compute_white_mask(
+                pixels[top:bottom],
+                alpha[top:bottom],
+                None if background is None else background[top:bottom],
+                threshold,
+                keep_alpha
+            )
+    finally:
+        # Views must be released before the segment can be closed
+        pixels = alpha = background = None
+        segment.close()
+
+
+class ProcessingPool:
+    """
+    Runs CPU-bound pixel work in a dedicated pool of worker processes.
+    
+    Decoded pixels are handed to workers through multiprocessing.shared_memory
+    rather than pickled bytes. A job that exceeds the timeout or a worker that
+    crashes causes the pool to be torn down and rebuilt, so one bad image
+    cannot wedge the pool for later requests.
+    
+    Jobs wait for an idle worker here rather than in the executor's queue,
+    so the timeout only counts time spent running and a backlog does not
+    turn into timeouts and restarts.
+    """
+    
+    def __init__(self,
+                 max_workers: Optional[int] = None,
+                 timeout: float = 60.0,
+                 start_method: str = "spawn"):
+        """
+        Initialize the processing pool. Worker processes start on first use.
+        
+        Args:
+            max_workers: Number of worker processes (defaults to CPU count)
+            timeout: Seconds a job may run on a worker before it is abandoned
+            start_method: multiprocessing start method for workers
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.start_method = start_method
+        
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._slots_pid = None
+        self._in_flight = 0
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'timeouts': 0,
+            'restarts': 0
+        }
+    
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """Return the live executor, creating one in this process if needed."""
+        with self._lock:
+            # An executor inherited across fork belongs to the parent
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context(self.start_method)
+                )
+                self._pid = os.getpid()
+            return self._executor
+    
+    def _acquire_worker(self) -> threading.Semaphore:
+        """Wait until a worker is idle; the caller releases the returned semaphore."""
+        with self._lock:
+            # Slots held by threads of a parent process are never released here
+            if self._slots is None or self._slots_pid != os.getpid():
+                self._slots = threading.Semaphore(self.max_workers)
+                self._slots_pid = os.getpid()
+            slots = self._slots
+        slots.acquire()
+        return slots
+    
+    def _restart(self, executor: ProcessPoolExecutor, reason: str) -> None:
+        """Tear down a failed executor unless another thread already replaced it."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._stats['restarts'] += 1
+        
+        logger.warning(f"Restarting processing pool: {reason}")
+        # ProcessPoolExecutor has no public way to stop a busy worker
+        for process in list(getattr(executor, '_processes', {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def submit(self, fn, *args, timeout: Optional[float] = None, retries: int = 1):
+        """
+        Run fn(*args) in a worker process and wait for its result.
+        
+        Args:
+            fn: Picklable module-level function
+            *args: Picklable arguments
+            timeout: Seconds the job may run once a worker picks it up
+                (defaults to the pool timeout)
+            retries: Times to resubmit after the pool broke underneath the job
+        
+        Returns:
+            The function's return value
+        """
+        timeout = self.timeout if timeout is None else timeout
+        
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._in_flight += 1
+            depth = self._in_flight
+        QUEUE_DEPTH.labels('processing').set(max(0, depth - self.max_workers))
+        logger.info(f"Processing pool queue depth: {depth}")
+        
+        slots = None
+        try:
+            slots = self._acquire_worker()
+            while True:
+                executor = self._get_executor()
+                try:
+                    result = executor.submit(fn, *args).result(timeout=timeout)
+                except FutureTimeoutError:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    self._restart(executor, f"job exceeded {timeout}s timeout")
+                    raise ProcessingTimeout(f"Image processing timed out after {timeout}s")
+                except BrokenProcessPool:
+                    # A worker died, taking every job queued on this executor with it
+                    self._restart(executor, "worker process crashed")
+                    if retries <= 0:
+                        raise ProcessingError("Image processing worker crashed")
+                    retries -= 1
+                    continue
+                
+                with self._lock:
+                    self._stats['completed'] += 1
+                return result
+        except Exception:
+            with self._lock:
+                self._stats['failed'] += 1
+            raise
+        finally:
+            if slots is not None:
+                slots.release()
+            with self._lock:
+                self._in_flight -= 1
+                depth = self._in_flight
+            QUEUE_DEPTH.labels('processing').set(max(0, depth - self.max_workers))
+    
+    def remove_white_background(self,
+                                img: Image.Image,
+                                threshold: int = DEFAULT_WHITE_THRESHOLD,
+                                matte: Optional[Tuple[int, int, int]] = None,
+                                keep_alpha: bool = False,
+                                memory_budget: int = DEFAULT_CUTOUT_MEMORY_BUDGET,
+                                timeout: Optional[float] = None) -> Image.Image:
+        """
+        Pool-backed equivalent of image_utils.remove_white_background.
+        
+        The pixels are copied once into a shared memory segment, a worker
+        computes the mask into the same segment, and the mask is attached here.
+        Output is identical to the in-process engine.
+        
+        Args:
+            img: PIL Image object in any mode
+            threshold: Channel value above which a pixel counts as white
+            matte: Optional RGB colour written into background pixels
+            keep_alpha: Keep the source alpha for foreground pixels
+            memory_budget: Cap in bytes for the worker's temporaries
+            timeout: Seconds the job may run once a worker picks it up
+                (defaults to the pool timeout)
+        
+        Returns:
+            RGBA PIL Image with transparent background
+        """
+        src = img if img.mode in ("RGB", "RGBA") else img.convert("RGBA")
+        src.load()
+        width, height = src.size
+        channels = len(src.getbands())
+        plane = width * height
+        planes = channels + (2 if matte is not None else 1)
+        
+        segment = shared_memory.SharedMemory(create=True, size=plane * planes)
+        pixels = alpha = background = None
+        try:
+            pixels = np.ndarray((height, width, channels), dtype=np.uint8, buffer=segment.buf)
+            band_rows = max(1, _COPY_BAND_BYTES // (width * channels))
+            for top in range(0, height, band_rows):
+                bottom = min(top + band_rows, height)
+                pixels[top:bottom] = np.asarray(src.crop((0, top, width, bottom)))
+            
+            self.submit(
+                _cut_shared,
+                segment.name,
+                (height, width, channels),
+                threshold,
+                keep_alpha,
+                matte is not None,
+                memory_budget,
+                timeout=timeout
+            )
+            
+            alpha = np.ndarray((height, width), dtype=np.uint8, buffer=segment.buf, offset=plane * channels)
+            if matte is not None:
+                background = np.ndarray((height, width), dtype=np.uint8, buffer=segment.buf, offset=plane * (channels + 1))
+            attach_white_mask(src, alpha, background, matte)
+        finally:
+            # Views must be released before the segment can be closed
+            pixels = alpha = background = None
+            segment.close()
+            segment.unlink()
+        
+        return src
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Report pool size, queue depth and job counters.
+        
+        Returns:
+            Dictionary of pool statistics
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            in_flight = self._in_flight
+        
+        stats.update({
+            'workers': self.max_workers,
+            'in_flight': in_flight,
+            'queue_depth': max(0, in_flight - self.max_workers)
+        })
+        return stats
+    
+    def shutdown(self) -> None:
+        """Stop the worker processes."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,108 @@
+# quota.py
+import logging
+from typing import Any, Dict, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """Raised when an account cannot take another image this month."""
+
+
+class Quota:
+    """
+    Monthly image allowance, enforced in MongoDB.
+    
+    A unit is reserved before a generation starts with one conditional
+    $inc on the user document, whose filter only matches while usage is
+    below the limit of the user's tier. MongoDB applies the filter and the
+    increment atomically, so any number of concurrent requests for one
+    account take at most the units that are left. A generation that fails
+    gives its unit back with refund(); one that succeeds keeps it, which
+    needs no further write.
+    """
+    
+    def __init__(self, collection, tiers: Dict[str, Dict[str, Any]], user_cache=None):
+        """
+        Initialize the quota.
+        
+        Args:
+            collection: MongoDB users collection
+            tiers: SUBSCRIPTION_TIERS map of tier name to its settings
+            user_cache: UserCache refreshed with the documents writes return
+        """
+        self.collection = collection
+        self.tiers = tiers
+        self.user_cache = user_cache
+        
+        # One clause per tier: usage below that tier's limit
+        self._below_limit = [
+            {'subscription.tier': tier, 'usage.images_generated': {'$lt': settings['images_per_month']}}
+            for tier, settings in tiers.items()
+        ]
+    
+    def limit(self, user: Dict[str, Any]) -> int:
+        """Images per month allowed by the user's tier, 0 without a subscription"""
+        tier = (user.get('subscription') or {}).get('tier')
+        return self.tiers[tier]['images_per_month'] if tier in self.tiers else 0
+    
+    def remaining(self, user: Dict[str, Any]) -> int:
+        """Images left this month according to a user document"""
+        return max(0, self.limit(user) - user['usage']['images_generated'])
+    
+    def reserve(self, email: str) -> Dict[str, Any]:
+        """
+        Take one unit of the user's allowance.
+        
+        Args:
+            email: User email
+        
+        Returns:
+            The user document after the reservation
+        
+        Raises:
+            QuotaExceeded: The user has no subscription or no images left
+        """
+        user = self.collection.find_one_and_update(
+            {'email': email, '$or': self._below_limit},
+            {'$inc': {'usage.images_generated': 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        
+        if user is None:
+            # Only to word the error; the decision was made by the update
+            current = self.user_cache.get(email) if self.user_cache else None
+            if current is not None and not current.get('subscription'):
+                raise QuotaExceeded("Active subscription required")
+            raise QuotaExceeded("Monthly image limit reached")
+        
+        if self.user_cache:
+            self.user_cache.put(user)
+        return user
+    
+    def refund(self, email: str) -> Optional[Dict[str, Any]]:
+        """
+        Give back a unit taken by reserve().
+        
+        Args:
+            email: User email
+        
+        Returns:
+            The user document after the refund, or None if there was no
+            unit to give back
+        """
+        user = self.collection.find_one_and_update(
+            {'email': email, 'usage.images_generated': {'$gt': 0}},
+            {'$inc': {'usage.images_generated': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        logger.info(f"Refunded an image to {email}")
+        
+        if self.user_cache:
+            if user is None:
+                self.user_cache.invalidate(email)
+            else:
+                self.user_cache.put(user)
+        return user
@@ -0,0 +1,171 @@
+# rendition_cache.py
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Default cap on the total size of cached renditions
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Eviction trims the cache to this fraction of max_bytes, so it runs rarely
+_LOW_WATER = 0.9
+
+
+class RenditionCache:
+    """
+    On-disk cache of derived images such as gallery thumbnails.
+    
+    Each rendition is a file named after the hash of its key, so every worker
+    process on the host serves the same files. Hits refresh the file's
+    access time, and once the directory grows past max_bytes the least
+    recently used files are removed. Renditions of a deleted source are
+    removed with discard().
+    
+    The running total is tracked per process and re-measured from disk on
+    each eviction, so renditions added by other processes are counted late;
+    the directory can overshoot max_bytes by at most one process's worth of
+    additions between scans.
+    """
+    
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Initialize the cache.
+        
+        Args:
+            directory: Folder holding cached renditions (created if missing)
+            max_bytes: Total size above which the oldest renditions are evicted
+        """
+        # Paths handed out must not depend on the directory they are opened from
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._bytes: Optional[int] = None
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'discards': 0
+        }
+    
+    def _path(self, key: str, extension: str) -> str:
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + extension)
+    
+    def get_or_create(self, key: str, extension: str, produce: Callable[[str], None]) -> str:
+        """
+        Return the path of a rendition, producing it on first use.
+        
+        Args:
+            key: Unique description of the rendition (source, size, format)
+            extension: File extension of the rendition, including the dot
+            produce: Function that writes the rendition to the path it is given
+        
+        Returns:
+            Path to the cached rendition
+        """
+        path = self._path(key, extension)
+        
+        try:
+            # Refresh the last-use time so eviction is least-recently-used,
+            # keeping the mtime that ETag and Last-Modified derive from
+            stat = os.stat(path)
+            os.utime(path, (time.time(), stat.st_mtime))
+            with self._lock:
+                self._stats['hits'] += 1
+            return path
+        except FileNotFoundError:
+            pass
+        
+        # Concurrent first requests may both produce; the rename keeps the file whole
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            produce(temp_path)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        with self._lock:
+            self._stats['misses'] += 1
+            if self._bytes is not None:
+                self._bytes += size
+            over = self._bytes is None or self._bytes > self.max_bytes
+        
+        if over:
+            self.evict()
+        return path
+    
+    def discard(self, key: str, extension: str) -> None:
+        """
+        Remove a rendition if it is cached.
+        
+        Args:
+            key: Key the rendition was created under
+            extension: File extension of the rendition, including the dot
+        """
+        path = self._path(key, extension)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        
+        with self._lock:
+            self._stats['discards'] += 1
+            if self._bytes is not None:
+                self._bytes -= size
+    
+    def evict(self) -> None:
+        """Measure the directory and remove least recently used renditions over max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+        
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        if total > self.max_bytes:
+            target = self.max_bytes * _LOW_WATER
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+        
+        with self._lock:
+            self._bytes = total
+            self._stats['evictions'] += evicted
+        if evicted:
+            logger.info(f"Evicted {evicted} renditions, {total} bytes cached")
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Report hit, miss and eviction counters.
+        
+        Returns:
+            Dictionary of cache statistics
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['bytes'] = self._bytes
+        
+        stats['max_bytes'] = self.max_bytes
+        return stats
@@ -0,0 +1,332 @@
+# storage.py
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Hashable, Iterator, Optional, Tuple
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Cache-Control stored with objects; keys are never rewritten once written
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Seconds an object store's answer to whether a key exists is reused
+DEFAULT_KEY_CACHE_TTL = 60.0
+
+# Presigned URLs stop being handed out this many seconds before they expire,
+# so clients that cached a redirect to one still have time to fetch it
+URL_EXPIRY_MARGIN = 300
+
+# Keys whose existence and presigned URLs are kept per process
+DEFAULT_MAX_CACHED_KEYS = 10000
+
+
+def storage_key(folder: str, filename: str) -> str:
+    """
+    Build the storage key for a file, sharded by a hash of its name.
+    
+    Two levels of 256 prefixes keep directories small on local disk and
+    spread keys across partitions on object stores. The shard is derived
+    from the filename without its extension, so a URL carrying only the
+    filename can be resolved, and a file re-encoded to another format stays
+    in the same shard.
+    
+    Args:
+        folder: Top-level folder, e.g. 'uploads' or 'processed'
+        filename: Name of the file
+    
+    Returns:
+        Storage key such as 'processed/3f/a2/generated_<uuid>.webp'
+    """
+    digest = hashlib.sha1(os.path.splitext(filename)[0].encode('utf-8')).hexdigest()
+    return f"{folder}/{digest[:2]}/{digest[2:4]}/{filename}"
+
+
+class Storage:
+    """
+    Interface of the blob storage backends.
+    
+    Files are addressed by storage key. put_file moves a local file into
+    storage; local_copy gives a local path to read a stored file from.
+    """
+    
+    def put_file(self, key: str, source_path: str, content_type: Optional[str] = None) -> None:
+        """Move a local file into storage under key. The source file is consumed."""
+        raise NotImplementedError
+    
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[str]:
+        """Context manager yielding a local path holding the file's contents."""
+        raise NotImplementedError
+    
+    def exists(self, key: str) -> bool:
+        """Check whether a key is stored."""
+        raise NotImplementedError
+    
+    def delete(self, key: str) -> None:
+        """Remove a key; missing keys are ignored."""
+        raise NotImplementedError
+    
+    def read_head(self, key: str, length: int) -> bytes:
+        """First length bytes of a stored file, enough to read its header."""
+        with self.local_copy(key) as path, open(path, 'rb') as f:
+            return f.read(length)
+    
+    def local_path(self, key: str) -> Optional[str]:
+        """Path the file can be served from directly, or None if it is remote."""
+        return None
+    
+    def url(self, key: str, download_name: Optional[str] = None) -> Optional[Tuple[str, int]]:
+        """
+        URL clients can fetch the file from directly and the seconds it may be
+        reused for, or None if the file must be proxied.
+        """
+        return None
+
+
+class _ExpiringCache:
+    """
+    Thread-safe map whose entries each expire at their own time. The least
+    recently used entries are dropped beyond max_entries.
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+    
+    def get(self, key: Hashable) -> Any:
+        """Value stored under key, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+            return None
+    
+    def put(self, key: Hashable, value: Any, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class LocalStorage(Storage):
+    """
+    Stores files on local disk under a root directory.
+    
+    Keys map to paths below the root, so legacy records holding flat paths
+    such as 'uploads/<name>' resolve as keys too.
+    """
+    
+    def __init__(self, root: str = '.'):
+        """
+        Args:
+            root: Directory keys are resolved against
+        """
+        self.root = root
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+    
+    def put_file(self, key: str, source_path: str, content_type: Optional[str] = None) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with stage('store'):
+            try:
+                os.replace(source_path, path)
+            except OSError:
+                # Staging area on another filesystem
+                shutil.move(source_path, path)
+    
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[str]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            raise FileNotFoundError(key)
+        yield path
+    
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+    
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+    
+    def local_path(self, key: str) -> Optional[str]:
+        return self._path(key)
+
+
+class S3Storage(Storage):
+    """
+    Stores files in an S3-compatible object store.
+    
+    Works with AWS S3 and with stand-ins such as MinIO or moto's server
+    mode by pointing endpoint_url at them. Clients are redirected to
+    presigned URLs rather than having the files proxied through the app.
+    
+    Serving a file would otherwise cost a HEAD request per candidate key and
+    a fresh signature per request, so both are cached per process. Whether a
+    key exists is reused for key_cache_ttl seconds, and writes made through
+    this object update the answer at once; other processes see a put or
+    delete at most key_cache_ttl seconds late. A presigned URL is handed out
+    again until URL_EXPIRY_MARGIN seconds before it expires, which lets
+    clients cache the redirect to it for as long.
+    """
+    
+    def __init__(self,
+                 bucket: str,
+                 endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None,
+                 access_key: Optional[str] = None,
+                 secret_key: Optional[str] = None,
+                 url_expiry: int = 3600,
+                 key_cache_ttl: float = DEFAULT_KEY_CACHE_TTL,
+                 max_cached_keys: int = DEFAULT_MAX_CACHED_KEYS):
+        """
+        Args:
+            bucket: Bucket name
+            endpoint_url: Endpoint of an S3-compatible service (None for AWS)
+            region: Region name
+            access_key: Access key id (falls back to the boto3 credential chain)
+            secret_key: Secret access key
+            url_expiry: Seconds presigned URLs stay valid
+            key_cache_ttl: Seconds an exists() answer is reused; 0 disables it
+            max_cached_keys: Keys whose existence and URLs are kept
+        """
+        # Only needed for this backend
+        import boto3
+        from botocore.exceptions import ClientError
+        
+        self.bucket = bucket
+        self.url_expiry = url_expiry
+        self.key_cache_ttl = key_cache_ttl
+        self._client_error = ClientError
+        self._known_keys = _ExpiringCache(max_cached_keys)
+        self._urls = _ExpiringCache(max_cached_keys)
+        self._client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key
+        )
+    
+    def put_file(self, key: str, source_path: str, content_type: Optional[str] = None) -> None:
+        extra_args = {'CacheControl': IMMUTABLE_CACHE_CONTROL}
+        if content_type:
+            extra_args['ContentType'] = content_type
+        with stage('store'):
+            self._client.upload_file(source_path, self.bucket, key, ExtraArgs=extra_args)
+        os.remove(source_path)
+        self._known_keys.put(key, True, self.key_cache_ttl)
+    
+    def _missing(self, error) -> bool:
+        """Whether a ClientError means the key is not stored"""
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
+    
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[str]:
+        # Keep the extension; some decoders look at it
+        handle, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(handle)
+        try:
+            try:
+                with stage('fetch'):
+                    self._client.download_file(self.bucket, key, path)
+            except self._client_error as e:
+                if self._missing(e):
+                    raise FileNotFoundError(key)
+                raise
+            yield path
+        finally:
+            os.remove(path)
+    
+    def read_head(self, key: str, length: int) -> bytes:
+        try:
+            with stage('fetch'):
+                response = self._client.get_object(Bucket=self.bucket, Key=key, Range=f'bytes=0-{length - 1}')
+                return response['Body'].read()
+        except self._client_error as e:
+            if self._missing(e):
+                raise FileNotFoundError(key)
+            raise
+    
+    def exists(self, key: str) -> bool:
+        known = self._known_keys.get(key)
+        if known is not None:
+            return known
+        
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=key)
+            exists = True
+        except self._client_error as e:
+            if not self._missing(e):
+                raise
+            exists = False
+        self._known_keys.put(key, exists, self.key_cache_ttl)
+        return exists
+    
+    def delete(self, key: str) -> None:
+        self._client.delete_object(Bucket=self.bucket, Key=key)
+        self._known_keys.put(key, False, self.key_cache_ttl)
+        self._urls.discard((key, None))
+    
+    def url(self, key: str, download_name: Optional[str] = None) -> Optional[Tuple[str, int]]:
+        cached = self._urls.get((key, download_name))
+        if cached is not None:
+            url, reuse_until = cached
+            return url, max(0, int(reuse_until - time.monotonic()))
+        
+        params = {'Bucket': self.bucket, 'Key': key}
+        if download_name:
+            params['ResponseContentDisposition'] = f'attachment; filename="{download_name}"'
+        url = self._client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_expiry)
+        
+        # Short expiries keep at least half their lifetime for reuse
+        reuse = self.url_expiry - min(URL_EXPIRY_MARGIN, self.url_expiry // 2)
+        self._urls.put((key, download_name), (url, time.monotonic() + reuse), reuse)
+        return url, reuse
+
+
+def create_storage(config) -> Storage:
+    """
+    Build the storage backend selected by the app configuration.
+    
+    Args:
+        config: Mapping with STORAGE_BACKEND ('local' or 's3') and the
+            backend's settings
+    
+    Returns:
+        Storage backend
+    """
+    backend = config.get('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(config.get('STORAGE_ROOT') or '.')
+    if backend == 's3':
+        return S3Storage(
+            config['S3_BUCKET'],
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region=config.get('S3_REGION'),
+            access_key=config.get('S3_ACCESS_KEY'),
+            secret_key=config.get('S3_SECRET_KEY'),
+            url_expiry=config.get('S3_URL_EXPIRY', 3600),
+            key_cache_ttl=config.get('S3_KEY_CACHE_TTL', DEFAULT_KEY_CACHE_TTL)
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,84 @@
+# conftest.py
+import os
+import sys
+import threading
+
+import pymongo
+import pytest
+
+# The app's modules sit next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# mongomock methods that write one document
+_SINGLE_DOCUMENT_WRITES = (
+    'find_one_and_update',
+    'find_one_and_delete',
+    'update_one',
+    'insert_one',
+    'delete_one'
+)
+
+
+@pytest.fixture(scope='session')
+def mongo_server():
+    """
+    MongoClient class and URI the tests connect with.
+
+    Tests run against the server at MONGO_TEST_URI when it is set, and
+    otherwise against mongomock. MongoDB applies each single-document write
+    atomically and mongomock does not, so its writes are serialised to give
+    concurrency tests the same guarantee.
+    """
+    uri = os.environ.get('MONGO_TEST_URI')
+    if uri:
+        yield pymongo.MongoClient, uri
+        return
+
+    import mongomock
+    lock = threading.RLock()
+    with pytest.MonkeyPatch.context() as patch:
+        for name in _SINGLE_DOCUMENT_WRITES:
+            method = getattr(mongomock.Collection, name)
+
+            def locked(self, *args, _method=method, **kwargs):
+                with lock:
+                    return _method(self, *args, **kwargs)
+
+            patch.setattr(mongomock.Collection, name, locked)
+        yield mongomock.MongoClient, 'mongodb://localhost:27017'
+
+
+@pytest.fixture
+def database(mongo_server):
+    """Empty database, dropped after the test."""
+    client_class, uri = mongo_server
+    client = client_class(uri)
+    yield client.image_visualization_test
+    client.drop_database('image_visualization_test')
+
+
+@pytest.fixture(scope='session')
+def app_module(mongo_server, tmp_path_factory):
+    """The app module, imported with its files kept in a temporary directory."""
+    client_class, uri = mongo_server
+    root = tmp_path_factory.mktemp('app')
+    cwd = os.getcwd()
+
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('MONGO_URI', uri)
+        patch.setenv('STORAGE_ROOT', str(root))
+        # The app creates its working folders relative to the current directory
+        os.chdir(root)
+        try:
+            import mongo
+            patch.setattr(mongo, 'MongoClient', client_class)
+            import app
+            app.app.config['TESTING'] = True
+            yield app
+        finally:
+            os.chdir(cwd)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
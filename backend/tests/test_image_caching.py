@@ -0,0 +1,92 @@
+# test_image_caching.py
+import io
+import os
+
+from PIL import Image
+
+from storage import storage_key
+
+
+def store_processed_image(app_module, filename, size=(64, 48)):
+    """Put a PNG in storage as /processed/<filename> serves it; returns its bytes"""
+    key = storage_key(app_module.app.config['PROCESSED_FOLDER'], filename)
+    path = app_module.storage.local_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', size, (200, 30, 30)).save(path, 'PNG')
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def get(client, url, **headers):
+    response = client.get(url, headers=headers)
+    body = response.get_data()
+    response.close()
+    return response, body
+
+
+def test_first_request_is_cacheable(app_module, client):
+    data = store_processed_image(app_module, 'cache_first.png')
+
+    response, body = get(client, '/processed/cache_first.png')
+
+    assert response.status_code == 200
+    assert body == data
+    assert response.headers['ETag']
+    assert response.headers['Last-Modified']
+    assert 'immutable' in response.headers['Cache-Control']
+
+
+def test_repeat_request_with_etag_transfers_no_body(app_module, client):
+    store_processed_image(app_module, 'cache_etag.png')
+    first, _ = get(client, '/processed/cache_etag.png')
+
+    response, body = get(client, '/processed/cache_etag.png', **{'If-None-Match': first.headers['ETag']})
+
+    assert response.status_code == 304
+    assert body == b''
+
+
+def test_repeat_request_with_last_modified_transfers_no_body(app_module, client):
+    store_processed_image(app_module, 'cache_modified.png')
+    first, _ = get(client, '/processed/cache_modified.png')
+
+    response, body = get(client, '/processed/cache_modified.png', **{'If-Modified-Since': first.headers['Last-Modified']})
+
+    assert response.status_code == 304
+    assert body == b''
+
+
+def test_range_request_returns_partial_content(app_module, client):
+    data = store_processed_image(app_module, 'cache_range.png')
+
+    response, body = get(client, '/processed/cache_range.png', Range='bytes=0-99')
+
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-99/{len(data)}'
+    assert body == data[:100]
+
+
+def test_thumbnail_is_served_from_any_working_directory(app_module, client, tmp_path, monkeypatch):
+    store_processed_image(app_module, 'thumb_served.png', (1200, 900))
+    monkeypatch.chdir(tmp_path)
+
+    response, body = get(client, '/processed/thumb_served.png?w=480&h=320&fit=cover', Accept='image/webp')
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'image/webp'
+    assert 'immutable' in response.headers['Cache-Control']
+    with Image.open(io.BytesIO(body)) as img:
+        assert img.size == (480, 320)
+
+
+def test_thumbnails_are_removed_with_their_image(app_module, client):
+    store_processed_image(app_module, 'thumb_deleted.png')
+    for accept in ('image/webp', 'image/jpeg'):
+        get(client, '/processed/thumb_deleted.png?w=160', Accept=accept)
+    cache = app_module.thumbnail_cache.directory
+    before = set(os.listdir(cache))
+
+    key = storage_key(app_module.app.config['PROCESSED_FOLDER'], 'thumb_deleted.png')
+    app_module.delete_stored_image(key)
+
+    assert len(before - set(os.listdir(cache))) == 2
@@ -0,0 +1,57 @@
+# test_jobs.py
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from jobs import JobQueue
+
+
+def running_job(collection, job_type, attempts, params=None, owner='owner@example.com'):
+    """Insert a job as a worker that claimed it would leave it"""
+    now = datetime.now()
+    job = {
+        'type': job_type,
+        'owner': owner,
+        'params': params or {},
+        'status': 'running',
+        'attempts': attempts,
+        'lease_expires_at': now + timedelta(minutes=5),
+        'created_at': now,
+        'updated_at': now
+    }
+    job['_id'] = collection.insert_one(job).inserted_id
+    return job
+
+
+def test_abandoned_job_calls_its_abandon_handler_once(database):
+    ran, abandoned = [], []
+    queue = JobQueue(database.jobs, handlers={'work': ran.append}, abandon_handlers={'work': abandoned.append}, max_attempts=2)
+    job = running_job(database.jobs, 'work', attempts=3)
+
+    queue._run(job)
+    # A stale claim of the same attempt records nothing more
+    queue._run(job)
+
+    assert ran == []
+    assert [abandoned_job['_id'] for abandoned_job in abandoned] == [job['_id']]
+    assert database.jobs.find_one({'_id': job['_id']})['status'] == 'failed'
+
+
+def test_abandoned_generation_gives_back_its_reservation(app_module):
+    email = 'abandoned@example.com'
+    app_module.users_collection.insert_one({
+        'email': email,
+        'subscription': {'tier': 'free'},
+        'usage': {'images_generated': 1}
+    })
+    job = running_job(
+        app_module.jobs_collection,
+        'generate',
+        attempts=app_module.job_queue.max_attempts + 1,
+        params={'image_id': str(ObjectId()), 'generated_id': 'never-generated'},
+        owner=email
+    )
+
+    app_module.job_queue._run(job)
+
+    assert app_module.users_collection.find_one({'email': email})['usage']['images_generated'] == 0
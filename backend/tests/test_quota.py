@@ -0,0 +1,107 @@
+# test_quota.py
+import threading
+import time
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+from quota import Quota, QuotaExceeded
+from sub_config import SUBSCRIPTION_TIERS
+
+EMAIL = 'busy@example.com'
+
+
+def test_parallel_reservations_stop_at_the_tier_limit(database):
+    database.users.insert_one({
+        'email': EMAIL,
+        'subscription': {'tier': 'business'},
+        'usage': {'images_generated': 0}
+    })
+    quota = Quota(database.users, SUBSCRIPTION_TIERS)
+    limit = SUBSCRIPTION_TIERS['business']['images_per_month']
+    attempts = 3 * limit
+
+    # Release every reservation at once
+    start = threading.Barrier(attempts)
+    results = []
+
+    def reserve():
+        start.wait()
+        try:
+            quota.reserve(EMAIL)
+            results.append(True)
+        except QuotaExceeded:
+            results.append(False)
+
+    threads = [threading.Thread(target=reserve) for _ in range(attempts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == attempts
+    assert results.count(True) == limit
+    assert database.users.find_one({'email': EMAIL})['usage']['images_generated'] == limit
+
+
+def test_refund_gives_a_unit_back(database):
+    database.users.insert_one({
+        'email': EMAIL,
+        'subscription': {'tier': 'free'},
+        'usage': {'images_generated': SUBSCRIPTION_TIERS['free']['images_per_month'] - 1}
+    })
+    quota = Quota(database.users, SUBSCRIPTION_TIERS)
+
+    quota.reserve(EMAIL)
+    quota.refund(EMAIL)
+    quota.reserve(EMAIL)
+
+    with pytest.raises(QuotaExceeded):
+        quota.reserve(EMAIL)
+
+
+def test_parallel_generations_stop_at_the_tier_limit(app_module, monkeypatch):
+    email = 'generator@example.com'
+    app_module.users_collection.insert_one({
+        'email': email,
+        'subscription': {'tier': 'starter'},
+        'usage': {'images_generated': 0}
+    })
+    image_id = app_module.images_collection.insert_one({
+        'owner': email,
+        'original_key': 'uploads/original.png',
+        'processed_key': 'processed/cutout.png'
+    }).inserted_id
+    limit = SUBSCRIPTION_TIERS['starter']['images_per_month']
+    attempts = 10 * limit
+
+    def generate(email, image_id, processed_key, scene, scene_prompt, use_cache=True):
+        # Long enough for the requests to overlap
+        time.sleep(0.01)
+        return {'generated_id': 'stub'}
+
+    monkeypatch.setattr(app_module, 'create_generated_image', generate)
+    with app_module.app.app_context():
+        headers = {'Authorization': 'Bearer ' + create_access_token(identity=email)}
+
+    start = threading.Barrier(attempts)
+    responses = []
+
+    def post():
+        client = app_module.app.test_client()
+        start.wait()
+        response = client.post('/api/generate', headers=headers, json={'image_id': str(image_id), 'scene': 'kitchen'})
+        responses.append((response.status_code, response.get_json()))
+
+    threads = [threading.Thread(target=post) for _ in range(attempts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(responses) == attempts
+    assert [status for status, _ in responses].count(200) == limit
+    assert sorted({(status, body['error']) for status, body in responses if status != 200}) == [
+        (403, 'Monthly image limit reached')
+    ]
+    assert app_module.users_collection.find_one({'email': email})['usage']['images_generated'] == limit
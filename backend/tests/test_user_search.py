@@ -0,0 +1,37 @@
+# test_user_search.py
+import pytest
+
+from user_search import search_query, search_terms
+
+USERS = [
+    {'email': 'john.smith@example.com', 'first_name': 'John', 'last_name': 'Smith', 'company_name': 'Acme'},
+    {'email': 'smith@xyz.com', 'first_name': 'John', 'last_name': 'Smith', 'company_name': ''},
+    {'email': 'jane@example.com', 'first_name': 'Jane', 'last_name': 'Doe', 'company_name': 'Blacksmith'}
+]
+
+
+@pytest.fixture
+def users(database):
+    database.users.insert_many([dict(user, search_terms=search_terms(user)) for user in USERS])
+    return database.users
+
+
+def search(users, text):
+    return sorted(user['email'] for user in users.find(search_query(text)))
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('smith', ['john.smith@example.com', 'smith@xyz.com']),
+    ('John Smith', ['john.smith@example.com', 'smith@xyz.com']),
+    ('john.smith@exa', ['john.smith@example.com']),
+    # Words match even when the text is not the start of an address
+    ('smith@example', ['john.smith@example.com']),
+    ('john smith@x', ['smith@xyz.com']),
+    ('nobody@example', [])
+])
+def test_search_finds_users_by_word_prefixes_or_address(users, text, expected):
+    assert search(users, text) == expected
+
+
+def test_search_without_words_matches_everything(users):
+    assert search_query(' @ ') == {}
@@ -0,0 +1,205 @@
+# upload_stream.py
+import io
+import os
+import hashlib
+import logging
+from typing import Callable, List, Optional
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.formparser import parse_form_data
+
+logger = logging.getLogger(__name__)
+
+# Formats accepted for product uploads, with their leading bytes
+UPLOAD_FORMATS = {
+    'JPEG': (b'\xff\xd8\xff',),
+    'PNG': (b'\x89PNG\r\n\x1a\n',),
+    'WEBP': (b'RIFF',)
+}
+
+# Default cap on width * height of an uploaded image
+DEFAULT_MAX_PIXELS = 40 * 1000 * 1000
+
+# Bytes kept in memory while waiting for a parseable header. JPEG headers
+# can trail large EXIF and ICC segments; anything longer is rejected
+_HEADER_LIMIT = 512 * 1024
+
+# Bytes needed to tell the formats apart
+_SIGNATURE_LENGTH = 12
+
+
+def _has_image_signature(head: bytes) -> bool:
+    if head[:4] == b'RIFF' and head[8:12] != b'WEBP':
+        return False
+    return any(head.startswith(signature)
+               for signatures in UPLOAD_FORMATS.values()
+               for signature in signatures)
+
+
+class UploadSink:
+    """
+    Writable stream the multipart parser fills with one uploaded file.
+
+    Each chunk is hashed and written to a staging file as it arrives, and
+    the image header is checked from the first chunks, so a non-image, an
+    image with too many pixels or a file over max_bytes is rejected before
+    the rest of the body is read. Memory use is bounded by the parser's
+    chunk size plus the buffered header, whatever the size of the file.
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None, max_pixels: int = DEFAULT_MAX_PIXELS):
+        """
+        Args:
+            path: Staging file to write to
+            max_bytes: Largest accepted file size
+            max_pixels: Largest accepted width * height
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+
+        self.size = 0
+        self.image_format: Optional[str] = None
+        self.dimensions: Optional[tuple] = None
+        self._digest = hashlib.sha256()
+        self._head: Optional[bytearray] = bytearray()
+        self._file = open(path, 'w+b')
+
+    @property
+    def content_hash(self) -> str:
+        """SHA-256 hex digest of the bytes written so far"""
+        return self._digest.hexdigest()
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.discard()
+            raise RequestEntityTooLarge(f"File exceeds the {self.max_bytes} byte upload limit")
+
+        if self._head is not None:
+            self._head += data
+            try:
+                self._check_header()
+            except Exception:
+                self.discard()
+                raise
+
+        self._digest.update(data)
+        self._file.write(data)
+        return len(data)
+
+    def _check_header(self) -> None:
+        """Identify the image from the buffered header once enough of it has arrived"""
+        head = bytes(self._head)
+        if len(head) < _SIGNATURE_LENGTH:
+            return
+        if not _has_image_signature(head):
+            raise UnsupportedMediaType("File is not a supported image (JPEG, PNG, WEBP)")
+
+        try:
+            # Parses the header only; pixel data is not decoded
+            with Image.open(io.BytesIO(head)) as img:
+                image_format, dimensions = img.format, img.size
+        except Image.DecompressionBombError:
+            raise RequestEntityTooLarge("Image dimensions are too large")
+        except Exception:
+            if len(head) >= _HEADER_LIMIT:
+                raise UnsupportedMediaType("File is not a supported image (JPEG, PNG, WEBP)")
+            # Header not complete yet
+            return
+
+        if image_format not in UPLOAD_FORMATS:
+            raise UnsupportedMediaType("File is not a supported image (JPEG, PNG, WEBP)")
+        width, height = dimensions
+        if width * height > self.max_pixels:
+            raise RequestEntityTooLarge(
+                f"Image dimensions {width}x{height} exceed the {self.max_pixels} pixel limit"
+            )
+
+        self.image_format = image_format
+        self.dimensions = dimensions
+        self._head = None
+
+    def finish(self) -> None:
+        """Close the staging file, rejecting uploads whose header never parsed"""
+        self._file.close()
+        if self.image_format is None:
+            self.discard()
+            raise UnsupportedMediaType("File is not a supported image (JPEG, PNG, WEBP)")
+
+    def discard(self) -> None:
+        """Close and delete the staging file"""
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # The parser rewinds the stream once the part is complete and
+    # FileStorage may read from it; both go to the staging file
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._file.seek(offset, whence)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._file.readline(size)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def receive_upload(environ,
+                   field: str,
+                   make_path: Callable[[], str],
+                   max_bytes: Optional[int] = None,
+                   max_pixels: int = DEFAULT_MAX_PIXELS) -> FileStorage:
+    """
+    Parse a multipart request body, streaming its file parts to staging.
+
+    Must be called before anything touches request.form or request.files.
+
+    Args:
+        environ: WSGI environment of the request
+        field: Form field holding the image
+        make_path: Function returning a new staging file path
+        max_bytes: Largest accepted request body, also applied per file
+        max_pixels: Largest accepted width * height
+
+    Returns:
+        The uploaded file; its stream is the finished UploadSink
+
+    Raises:
+        werkzeug.exceptions.HTTPException: 400 when no file was sent, 413
+            when the body, file or image dimensions are too large, 415 when
+            the file is not a supported image. Nothing is left in staging.
+    """
+    sinks: List[UploadSink] = []
+
+    def stream_factory(total_content_length, content_type, filename=None, content_length=None):
+        sink = UploadSink(make_path(), max_bytes=max_bytes, max_pixels=max_pixels)
+        sinks.append(sink)
+        return sink
+
+    try:
+        _, _, files = parse_form_data(environ, stream_factory=stream_factory, max_content_length=max_bytes)
+
+        upload = files.get(field)
+        if upload is None:
+            raise BadRequest("No file provided")
+        if upload.filename == '':
+            raise BadRequest("No file selected")
+        upload.stream.finish()
+    except BaseException:
+        for sink in sinks:
+            sink.discard()
+        raise
+
+    # Other file parts are not used
+    for sink in sinks:
+        if sink is not upload.stream:
+            sink.discard()
+
+    logger.info(f"Received {upload.stream.image_format} upload of {upload.stream.size} bytes")
+    return upload
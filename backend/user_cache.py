@@ -0,0 +1,120 @@
+# user_cache.py
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cached user document is served before it is read again
+DEFAULT_TTL = 30.0
+
+# Users kept per process; the least recently used are dropped beyond this
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class UserCache:
+    """
+    Short-lived per-process cache of user documents keyed by email.
+    
+    Authenticated routes look up the user behind the JWT identity on every
+    request. The cache serves that lookup from memory for ttl seconds.
+    Writes made in this process replace the entry with the document the
+    write returned (put) or drop it (invalidate). Other processes see a
+    change at most ttl seconds late, so the ttl is kept short and the
+    cache must not decide anything that needs the current value, such as
+    taking a unit of quota.
+    
+    Cached documents are shared between callers and must not be modified.
+    """
+    
+    def __init__(self, collection, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        Initialize the cache.
+        
+        Args:
+            collection: MongoDB users collection
+            ttl: Seconds an entry is served; 0 disables caching
+            max_entries: Number of users kept
+        """
+        self.collection = collection
+        self.ttl = ttl
+        self.max_entries = max_entries
+        
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'invalidations': 0
+        }
+    
+    def get(self, email: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the user with this email, reading MongoDB only on a miss.
+        
+        Args:
+            email: User email (the JWT identity)
+        
+        Returns:
+            User document, or None if there is no such user
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(email)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+        
+        user = self.collection.find_one({'email': email})
+        # Unknown users are not cached, so a new registration is seen at once
+        if user is not None:
+            self.put(user)
+        return user
+    
+    def put(self, user: Optional[Dict[str, Any]]) -> None:
+        """
+        Store a user document read or returned by a write in this process.
+        
+        Args:
+            user: Complete user document; None is ignored
+        """
+        if user is None or self.ttl <= 0:
+            return
+        
+        with self._lock:
+            self._entries[user['email']] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user['email'])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, email: str) -> None:
+        """
+        Drop a user so the next lookup reads MongoDB.
+        
+        Args:
+            email: User email
+        """
+        with self._lock:
+            if self._entries.pop(email, None) is not None:
+                self._stats['invalidations'] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Report hit, miss and invalidation counters.
+        
+        Returns:
+            Dictionary of cache statistics
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        
+        stats.update({
+            'ttl': self.ttl,
+            'max_entries': self.max_entries
+        })
+        return stats
@@ -0,0 +1,163 @@
+# user_search.py
+import re
+import json
+import base64
+import logging
+from datetime import datetime
+from typing import Any, Dict, List
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Fields whose words are searchable, normalised into the search_terms array
+SEARCH_FIELDS = ('email', 'first_name', 'last_name', 'company_name')
+
+# Keys the admin user list can be sorted and paged by; each has an index
+# ending in _id so a page is a range scan whatever its depth
+SORT_KEYS = ('created_at', 'email', 'last_name', 'company_name')
+
+# Users updated per batch when filling in search_terms for existing users
+_BACKFILL_BATCH = 1000
+
+_WORD = re.compile(r'[^\W_]+')
+
+
+def search_terms(user: Dict[str, Any]) -> List[str]:
+    """
+    Lowercase words a user can be found by.
+    
+    Every word of the name and company fields is a term, as are the whole
+    email address and each of its parts, so a search for "smith",
+    "smith@example.com" or "example" finds smith@example.com.
+    
+    Args:
+        user: User document
+    
+    Returns:
+        Sorted list of distinct terms
+    """
+    terms = set()
+    for field in SEARCH_FIELDS:
+        value = (user.get(field) or '').lower()
+        terms.update(_WORD.findall(value))
+        if field == 'email' and value:
+            terms.add(value)
+    return sorted(terms)
+
+
+def search_query(text: str) -> Dict[str, Any]:
+    """
+    Query clause matching users with a term starting with each searched word.
+    
+    Text containing '@' also matches users whose whole email address starts
+    with it, as an alternative to the words. The regexes are anchored and
+    case-sensitive against the lowercase terms, so MongoDB answers them from
+    the search_terms index.
+    
+    Args:
+        text: Search box contents
+    
+    Returns:
+        Query clause, empty if text has no words
+    """
+    text = text.strip().lower()
+    words = _WORD.findall(text)
+    if not words:
+        return {}
+    
+    query = {'$and': [{'search_terms': _prefix(word)} for word in words]}
+    if '@' in text:
+        # Match addresses as typed, not only word by word
+        return {'$or': [{'search_terms': _prefix(text)}, query]}
+    return query
+
+
+def _prefix(term: str):
+    return re.compile('^' + re.escape(term))
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode_cursor(user: Dict[str, Any], sort_by: str) -> str:
+    """Opaque cursor pointing just past a user in the list ordering"""
+    value = user.get(sort_by)
+    position = json.dumps([_json_value(value), isinstance(value, datetime), str(user['_id'])])
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str, sort_by: str, sort_order: int) -> Dict[str, Any]:
+    """
+    Query clause selecting the users after a cursor.
+    
+    Args:
+        cursor: Value from encode_cursor
+        sort_by: One of SORT_KEYS
+        sort_order: 1 for ascending, -1 for descending
+    
+    Returns:
+        Query clause
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        value, is_date, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if is_date:
+            value = datetime.fromisoformat(value)
+        user_id = ObjectId(user_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    
+    after = '$gt' if sort_order == 1 else '$lt'
+    # Ties on the sort key are broken by id in the same direction
+    clauses = [{sort_by: value, '_id': {after: user_id}}]
+    # Comparisons do not cross types, and users without the field sort
+    # before every value
+    if value is None:
+        if sort_order == 1:
+            clauses.append({sort_by: {'$ne': None}})
+    else:
+        clauses.append({sort_by: {after: value}})
+        if sort_order != 1:
+            clauses.append({sort_by: None})
+    return {'$or': clauses}
+
+
+def create_indexes(collection) -> None:
+    """Create the search and keyset pagination indexes on the users collection."""
+    collection.create_index('search_terms')
+    for key in SORT_KEYS:
+        collection.create_index([(key, 1), ('_id', 1)])
+
+
+def backfill_search_terms(collection) -> int:
+    """
+    Set search_terms on users created before the field existed.
+    
+    Args:
+        collection: MongoDB users collection
+    
+    Returns:
+        Number of users updated
+    """
+    updated = 0
+    while True:
+        users = list(collection.find(
+            {'search_terms': {'$exists': False}},
+            {field: 1 for field in SEARCH_FIELDS}
+        ).limit(_BACKFILL_BATCH))
+        if not users:
+            break
+        collection.bulk_write([
+            UpdateOne({'_id': user['_id']}, {'$set': {'search_terms': search_terms(user)}})
+            for user in users
+        ], ordered=False)
+        updated += len(users)
+    
+    if updated:
+        logger.info(f"Added search terms to {updated} users")
+    return updated
@@ -204,7 +204,7 @@ const ImageGallery = ({ user }) => {
                       <CardMedia
                       component="img"
                       height="200"
-                      image={getImageUrl(image.generated_images[0].path, image.generated_images[0].url)}
+                      image={getImageUrl(image.generated_images[0].path, image.generated_images[0].thumbnail_url || image.generated_images[0].url)}
                       alt="Generated visualization"
                       sx={{ objectFit: 'cover', cursor: 'pointer' }}
                       onClick={() => handleImageClick(image)}